@@ -1,21 +1,25 @@
 from setuptools import setup
 
-setup(name='HD_BET',
+setup(name='udcm2bids',
       version='1.0',
-      description='Tool for brain extraction',
-      url='https://github.com/MIC-DKFZ/hd-bet',
-      python_requires='>=3.5',
-      author='Fabian Isensee',
-      author_email='f.isensee@dkfz.de',
-      license='Apache 2.0',
+      description='Convert UIH DICOM exports into bids format',
+      url='https://github.com/devhliu/udcm2bids',
+      python_requires='>=3.10',
+      author='hui.liu02@united-imaging.com',
+      author_email='hui.liu02@united-imaging.com',
       zip_safe=False,
+      packages=['udcm2bids'],
+      package_data={'udcm2bids': ['exe/*']},
       install_requires=[
       'numpy',
-      'torch>=0.4.1',
-      'scikit-image',
-      'SimpleITK'
+      'nibabel',
+      'pydicom>=3',
+      'pandas',
+      'openpyxl'
       ],
-      scripts=['HD_BET/hd-bet'],
+      entry_points={
+          'console_scripts': ['udcm2bids=udcm2bids.cli:main']
+      },
       classifiers=[
           'Intended Audience :: Science/Research',
           'Programming Language :: Python',
@@ -23,4 +27,3 @@ setup(name='HD_BET',
           'Operating System :: Unix'
       ]
       )
-
@@ -0,0 +1,17 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    __main__.py
+#   Purpose:
+#       python -m udcm2bids, same as the udcm2bids command
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,283 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    benchmark.py
+#   Purpose:
+#       synthetic UIH export trees and timing of inventory, copy and conversion
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from glob import glob
+from datetime import datetime
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from pydicom.dataset import Dataset
+from pydicom.dataset import FileDataset
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import generate_uid
+
+_pet_sop_class = '1.2.840.10008.5.1.4.1.1.128'
+_mr_sop_class = '1.2.840.10008.5.1.4.1.1.4'
+
+#----------------------------------------------------------------------------------------
+#
+# synthetic UIH export tree
+#
+#----------------------------------------------------------------------------------------
+#----------------------------------------------------------------------------------------
+#
+def _write_slice(dcm_file, series_tags, acq_datetime, z, instance_number, matrix, rng):
+    """
+    :param dcm_file:
+    :param series_tags:     dict of tags shared by the series
+    :param acq_datetime:    datetime of the frame
+    :param z:               slice index
+    :param instance_number:
+    :param matrix:          rows and columns
+    :param rng:             numpy random generator
+    :return:
+    """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = series_tags['SOPClassUID']
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(dcm_file, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    for tag, value in series_tags.items(): setattr(ds, tag, value)
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.InstanceNumber = instance_number
+    ds.AcquisitionDate = acq_datetime.strftime('%Y%m%d')
+    ds.AcquisitionTime = acq_datetime.strftime('%H%M%S.%f')
+    ds.AcquisitionDateTime = acq_datetime.strftime('%Y%m%d%H%M%S.%f')
+    ds.ImagePositionPatient = [-0.5 * matrix * 2.0, -0.5 * matrix * 2.0, 2.0 * z]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [2.0, 2.0]
+    ds.SliceThickness = '2.0'
+    ds.Rows = matrix
+    ds.Columns = matrix
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.RescaleSlope = '%.6f' % rng.uniform(0.5, 2.0)
+    ds.RescaleIntercept = '0'
+    ds.PixelData = rng.integers(0, 4096, size=(matrix, matrix), dtype=np.uint16).tobytes()
+    ds.save_as(dcm_file, enforce_file_format=True)
+    return
+#----------------------------------------------------------------------------------------
+#
+def _write_series(series_root, series_tags, start, n_frames, n_slices, matrix, rng,
+                  frame_secs=60):
+    """
+    :param series_root:
+    :param series_tags:
+    :param start:           datetime of the first frame
+    :param n_frames:
+    :param n_slices:
+    :param matrix:
+    :param rng:
+    :param frame_secs:
+    :return:                number of written files
+    """
+    os.makedirs(series_root, exist_ok=True)
+    series_tags = dict(series_tags, SeriesInstanceUID=generate_uid())
+    instance_number = 0
+    for t in range(n_frames):
+        acq_datetime = start + timedelta(seconds=t * frame_secs)
+        for z in range(n_slices):
+            instance_number += 1
+            dcm_file = os.path.join(series_root, '%08d.dcm' % instance_number)
+            _write_slice(dcm_file, series_tags, acq_datetime, z, instance_number, matrix, rng)
+    return instance_number
+#----------------------------------------------------------------------------------------
+#
+def make_uih_tree(uih_dcm_root, n_patients=4, pet_frames=6, pet_slices=32,
+                  mr_slices=64, matrix=128, seed=0):
+    """
+    every patient has a static PET, a dynamic PET and a T1 MR series, half of the
+    patients use the '<study>/Image/<name>_<id>_<n>' layout
+    :param uih_dcm_root:
+    :param n_patients:
+    :param pet_frames:      frames of the dynamic PET series
+    :param pet_slices:      slices per PET frame
+    :param mr_slices:
+    :param matrix:          rows and columns of every slice
+    :param seed:
+    :return:                number of written files
+    """
+    rng = np.random.default_rng(seed)
+    study_date = datetime(2019, 5, 28, 9, 0, 0)
+    n_files = 0
+    for p in range(n_patients):
+        study_root = os.path.join(uih_dcm_root, '2019%04d' % (p + 1))
+        if p % 2 == 1: study_root = os.path.join(study_root, 'Image')
+        patient_root = os.path.join(study_root, 'Patient%03d_%03d_%d' % (p, p, p))
+        patient_tags = {'PatientName': 'Patient%03d' % p,
+                        'PatientID': '%03d' % p,
+                        'PatientWeight': '%.1f' % rng.uniform(50, 90),
+                        'StudyDate': study_date.strftime('%Y%m%d'),
+                        'StudyInstanceUID': generate_uid(),
+                        'Manufacturer': 'UIH'}
+        radionuclide = Dataset()
+        radionuclide.RadionuclideHalfLife = '6586.2'
+        radionuclide.RadionuclideTotalDose = '%.1f' % rng.uniform(2.0e8, 4.0e8)
+        radionuclide.RadiopharmaceuticalStartDateTime = study_date.strftime('%Y%m%d%H%M%S.00')
+        pet_tags = dict(patient_tags, Modality='PT', SOPClassUID=_pet_sop_class,
+                        RadiopharmaceuticalInformationSequence=[radionuclide])
+        mr_tags = dict(patient_tags, Modality='MR', SOPClassUID=_mr_sop_class)
+        n_files += _write_series(os.path.join(patient_root, 'pet_static_1'),
+                                 dict(pet_tags, SeriesDescription='pet_static'),
+                                 study_date + timedelta(minutes=40), 1, pet_slices, matrix, rng)
+        n_files += _write_series(os.path.join(patient_root, 'pet_dynamic_2'),
+                                 dict(pet_tags, SeriesDescription='pet_dynamic'),
+                                 study_date + timedelta(minutes=5), pet_frames, pet_slices,
+                                 matrix, rng)
+        n_files += _write_series(os.path.join(patient_root, 't1_mprage_3'),
+                                 dict(mr_tags, SeriesDescription='t1_mprage'),
+                                 study_date + timedelta(minutes=20), 1, mr_slices, matrix, rng)
+    return n_files
+#----------------------------------------------------------------------------------------
+#
+# timed stages
+#
+#----------------------------------------------------------------------------------------
+#----------------------------------------------------------------------------------------
+#
+_bids_func_info = [{'series_description': 'pet_static',
+                    'type': 'PET',
+                    'bids_func_name': 'pet',
+                    'bids_task_name': 'static'},
+                   {'series_description': 'pet_dynamic',
+                    'type': 'PET',
+                    'bids_func_name': 'pet',
+                    'bids_task_name': 'dynamic'},
+                   {'series_description': 't1_mprage',
+                    'type': 'T1W',
+                    'bids_func_name': 'anat',
+                    'bids_task_name': 'rest'}]
+#----------------------------------------------------------------------------------------
+#
+def _peak_rss_mb():
+    """
+    :return:    peak resident set size of this process and its children in MB, None on windows
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1.0 / 1024.0 if sys.platform != 'darwin' else 1.0 / 1024.0 / 1024.0
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+#----------------------------------------------------------------------------------------
+#
+def _run_stage(stage, work_root, n_workers):
+    """
+    run in a fresh process so peak rss belongs to the stage only
+    :param stage:
+    :param work_root:
+    :param n_workers:
+    :return:            (wall seconds, peak rss MB, units processed or None for all dicom files)
+    """
+    from . import udcmview
+    from . import udcm2bids
+    uih_dcm_root = os.path.join(work_root, 'uih')
+    bids_root = os.path.join(work_root, 'bids')
+    start = time.perf_counter()
+    n_units = None
+    if stage == 'dump_series2json':
+        udcmview.dump_series2json(uih_dcm_root, mode='multi_per_dir')
+    elif stage == 'dump_series2xlsx':
+        udcmview.dump_series2xlsx(uih_dcm_root, os.path.join(work_root, 'inventory.xlsx'),
+                                  mode='multi_per_dir')
+    elif stage == 'cp_series':
+        csv_file = os.path.join(work_root, 'inventory.csv')
+        udcmview.dump_series2csv(uih_dcm_root, csv_file, mode='multi_per_dir')
+        df = udcmview._read_inventory(csv_file)
+        df['07_Load'] = True
+        df.to_csv(csv_file, index=False)
+        start = time.perf_counter()
+        udcmview.cp_series(csv_file, os.path.join(work_root, 'staged'))
+    elif stage == 'convert_uih_dcm_2_bids':
+        os.makedirs(bids_root, exist_ok=True)
+        udcm2bids.convert_uih_dcm_2_bids(uih_dcm_root, bids_root, _bids_func_info,
+                                         n_workers=n_workers)
+    elif stage == 'suvbw_conversion':
+        bqml_nii_files = glob(os.path.join(bids_root, '*', 'pet', '*dynamic_PET-BQML.nii.gz'))
+        start = time.perf_counter()
+        for bqml_nii_file in bqml_nii_files:
+            with open(bqml_nii_file.replace('.nii.gz', '.json').replace('BQML', 'SUVbw')) as f:
+                suv_factor = json.load(f)['suvbw_factor']
+            udcm2bids._bqml_2_suvbw(bqml_nii_file, os.path.join(work_root, 'suvbw.nii.gz'),
+                                    suv_factor)
+        # no dicom file is read, the stage rescales nifti files
+        n_units = len(bqml_nii_files)
+    else:
+        raise ValueError('unknown benchmark stage %s' % stage)
+    return time.perf_counter() - start, _peak_rss_mb(), n_units
+#----------------------------------------------------------------------------------------
+#
+def run_benchmarks(work_root=None, results_file=None, n_workers=1, **tree_args):
+    """
+    :param work_root:       folder for the synthetic tree and outputs, temporary if None
+    :param results_file:    json-lines file to append results, stdout if None
+    :param n_workers:       workers of convert_uih_dcm_2_bids
+    :param tree_args:       passed to make_uih_tree
+    :return:                list of result dicts
+    """
+    stages = ['dump_series2json', 'dump_series2xlsx', 'cp_series',
+              'convert_uih_dcm_2_bids', 'suvbw_conversion']
+    remove_root = work_root is None
+    if work_root is None: work_root = tempfile.mkdtemp(prefix='udcm2bids-bench-')
+    try:
+        n_files = make_uih_tree(os.path.join(work_root, 'uih'), **tree_args)
+        n_bytes = sum(os.path.getsize(file) for file in
+                      glob(os.path.join(work_root, 'uih', '**', '*.dcm'), recursive=True))
+        results = []
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                wall_secs, peak_rss_mb, n_units = executor.submit(_run_stage, stage, work_root,
+                                                                  n_workers).result()
+            unit = 'dicom'
+            if n_units is None: n_units = n_files
+            else: unit = 'nifti'
+            result = {'stage': stage,
+                      'timestamp': datetime.now().isoformat(),
+                      'n_files': n_files,
+                      'n_bytes': n_bytes,
+                      'n_workers': n_workers,
+                      'tree': tree_args,
+                      'wall_secs': wall_secs,
+                      'unit': unit,
+                      'n_units': n_units,
+                      'units_per_sec': n_units / wall_secs if wall_secs > 0 else 0.0,
+                      'peak_rss_mb': peak_rss_mb}
+            # dicom throughput only for stages reading the dicom tree
+            if unit == 'dicom': result['files_per_sec'] = result['units_per_sec']
+            results.append(result)
+            line = json.dumps(result)
+            if results_file is None: print(line)
+            else:
+                with open(results_file, 'at', encoding='utf-8') as f_json: f_json.write(line + '\n')
+    finally:
+        if remove_root: shutil.rmtree(work_root, ignore_errors=True)
+    return results
+#----------------------------------------------------------------------------------------
+#
+# Test Purpose
+#
+#----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    run_benchmarks(n_workers=os.cpu_count() or 1)
@@ -0,0 +1,123 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    bulkcopy.py
+#   Purpose:
+#       to copy many dicom files concurrently, linking or cloning when possible
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+
+from .scheduler import run_jobs
+
+# linux ioctl to clone file extents on btrfs/xfs
+_FICLONE = 0x40049409
+
+#----------------------------------------------------------------------------------------
+#
+def _is_identical(src, dst):
+    """
+    :param src:
+    :param dst:
+    :return:        True if dst is src or has the same size and mtime
+    """
+    try:
+        st_dst = os.stat(dst)
+    except OSError:
+        return False
+    st_src = os.stat(src)
+    if (st_src.st_dev, st_src.st_ino) == (st_dst.st_dev, st_dst.st_ino): return True
+    return st_src.st_size == st_dst.st_size and st_src.st_mtime_ns == st_dst.st_mtime_ns
+#----------------------------------------------------------------------------------------
+#
+def _clone_file(src, dst):
+    """
+    :param src:
+    :param dst:
+    :return:        True if dst was written by reflink or copy_file_range
+    """
+    if sys.platform != 'linux': return False
+    import fcntl
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+            return True
+        except OSError:
+            pass
+        if not hasattr(os, 'copy_file_range'): return False
+        remaining = os.fstat(f_src.fileno()).st_size
+        try:
+            while remaining > 0:
+                n = os.copy_file_range(f_src.fileno(), f_dst.fileno(), remaining)
+                if n <= 0: break
+                remaining -= n
+        except OSError:
+            return False
+        return remaining <= 0
+#----------------------------------------------------------------------------------------
+#
+def copy_file(src, dst, method='auto'):
+    """
+    :param src:
+    :param dst:
+    :param method:  'auto' - reflink, copy_file_range or plain copy
+                    'hardlink' - hardlink when on the same filesystem, else as 'auto'
+    :return:        ('skipped' / 'linked' / 'copied', number of bytes copied)
+    """
+    if _is_identical(src, dst): return 'skipped', 0
+    if method == 'hardlink':
+        try:
+            if os.path.exists(dst): os.remove(dst)
+            os.link(src, dst)
+            return 'linked', 0
+        except OSError:
+            pass
+    # copy to a temporary name so an interrupted copy is never taken as identical
+    part = dst + '.part'
+    if not _clone_file(src, part): shutil.copyfile(src, part)
+    st_src = os.stat(src)
+    os.utime(part, ns=(st_src.st_atime_ns, st_src.st_mtime_ns))
+    os.replace(part, dst)
+    return 'copied', st_src.st_size
+#----------------------------------------------------------------------------------------
+#
+def _copy_job(job):
+    """
+    :param job:     (src, dst, method)
+    :return:
+    """
+    src, dst, method = job
+    return copy_file(src, dst, method=method)
+#----------------------------------------------------------------------------------------
+#
+def copy_files(file_pairs, n_workers=16, method='auto'):
+    """
+    :param file_pairs:  [(src, dst), ...], destination folders must exist
+    :param n_workers:   concurrent copies, network shares favour more than cpu count
+    :param method:      see copy_file
+    :return:            {'n_files', 'n_copied', 'n_linked', 'n_skipped', 'n_failed',
+                         'n_bytes', 'elapsed_secs'}
+    """
+    jobs = [(src, dst, method) for src, dst in file_pairs]
+    results, stats = run_jobs(_copy_job, jobs, n_workers=n_workers)
+    summary = {'n_files': stats['n_jobs'],
+               'n_copied': 0,
+               'n_linked': 0,
+               'n_skipped': 0,
+               'n_failed': stats['n_failed'],
+               'n_bytes': 0,
+               'elapsed_secs': stats['elapsed_secs']}
+    for job, ok, result in results:
+        if not ok:
+            print('failed to copy %s' % (job[0]))
+            continue
+        action, n_bytes = result
+        summary['n_' + action] += 1
+        summary['n_bytes'] += n_bytes
+    return summary
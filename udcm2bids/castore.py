@@ -0,0 +1,181 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    castore.py
+#   Purpose:
+#       content-addressed store of dicom files, staged trees are links into the store
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import uuid
+import filecmp
+import hashlib
+
+from pydicom.errors import InvalidDicomError
+
+from .bulkcopy import copy_file
+from .bulkcopy import _is_identical
+from .dcmscan import read_dcm_header
+from .scheduler import run_jobs
+
+#----------------------------------------------------------------------------------------
+#
+def _file_sha1(file):
+    """
+    :param file:
+    :return:        sha1 hex digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+#----------------------------------------------------------------------------------------
+#
+def _same_content(file_0, file_1):
+    """
+    :param file_0:
+    :param file_1:
+    :return:        True if both are one file or hold the same bytes
+    """
+    st_0, st_1 = os.stat(file_0), os.stat(file_1)
+    if (st_0.st_dev, st_0.st_ino) == (st_1.st_dev, st_1.st_ino): return True
+    if st_0.st_size != st_1.st_size: return False
+    return filecmp.cmp(file_0, file_1, shallow=False)
+#----------------------------------------------------------------------------------------
+#
+def object_key(file, key='sop'):
+    """
+    :param file:
+    :param key:     'sop' - SOPInstanceUID from the header, content hash if missing
+                    'sha1' - content hash
+    :return:        (kind, hex digest) naming the object in the store
+    """
+    if key not in ('sop', 'sha1'): raise ValueError('unknown store key %s' % key)
+    if key == 'sop':
+        try:
+            sop_uid = str(getattr(read_dcm_header(file, tags=['SOPInstanceUID']),
+                                  'SOPInstanceUID', ''))
+        except InvalidDicomError:
+            sop_uid = ''
+        if sop_uid: return 'sop', hashlib.sha1(sop_uid.encode('utf-8')).hexdigest()
+    return 'sha1', _file_sha1(file)
+#----------------------------------------------------------------------------------------
+#
+def object_file(store_root, kind, digest):
+    """
+    :param store_root:
+    :param kind:
+    :param digest:
+    :return:            <store_root>/<kind>/<digest[:2]>/<digest>.dcm
+    """
+    return os.path.join(store_root, kind, digest[:2], digest + '.dcm')
+#----------------------------------------------------------------------------------------
+#
+def _ingest(src, obj):
+    """
+    copy src into the store unless another worker or export stored it first
+    :param src:
+    :param obj:
+    :return:        number of bytes copied
+    """
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    tmp = '%s.%s.tmp' % (obj, uuid.uuid4().hex)
+    try:
+        _, n_bytes = copy_file(src, tmp)
+        try:
+            # link fails if the object exists, so the first writer wins
+            os.link(tmp, obj)
+        except FileExistsError:
+            return 0
+        except OSError:
+            os.replace(tmp, obj)
+            return n_bytes
+        return n_bytes
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+#----------------------------------------------------------------------------------------
+#
+def _link_object(obj, dst):
+    """
+    :param obj:
+    :param dst:
+    :return:        replace dst atomically with a hardlink, symlink or copy of obj
+    """
+    tmp = '%s.%s.link' % (dst, uuid.uuid4().hex)
+    try:
+        os.link(obj, tmp)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(obj), tmp)
+        except OSError:
+            copy_file(obj, tmp)
+    os.replace(tmp, dst)
+    return
+#----------------------------------------------------------------------------------------
+#
+def stage_file(src, dst, store_root, key='sop'):
+    """
+    :param src:
+    :param dst:
+    :param store_root:  folder of the store, may be shared between runs and exports
+    :param key:         see object_key, a 'sop' object with other bytes falls back to 'sha1'
+    :return:            ('skipped' / 'linked' / 'stored', number of bytes copied)
+                        skipped - dst is already up to date, metadata only
+                        linked - the object was in the store, only dst was linked
+                        stored - new object copied into the store and linked
+    """
+    if _is_identical(src, dst): return 'skipped', 0
+    kind, digest = object_key(src, key=key)
+    obj = object_file(store_root, kind, digest)
+    if kind == 'sop' and os.path.exists(obj) and not _same_content(src, obj):
+        # same SOPInstanceUID with other content, e.g. a corrected or re-anonymised export
+        obj = object_file(store_root, 'sha1', _file_sha1(src))
+    n_bytes = 0
+    action = 'linked'
+    if not os.path.exists(obj):
+        n_bytes = _ingest(src, obj)
+        if n_bytes > 0: action = 'stored'
+    _link_object(obj, dst)
+    return action, n_bytes
+#----------------------------------------------------------------------------------------
+#
+def _stage_job(job):
+    """
+    :param job:     (src, dst, store_root, key)
+    :return:
+    """
+    src, dst, store_root, key = job
+    return stage_file(src, dst, store_root, key=key)
+#----------------------------------------------------------------------------------------
+#
+def stage_files(file_pairs, store_root, key='sop', n_workers=16):
+    """
+    :param file_pairs:  [(src, dst), ...], destination folders must exist
+    :param store_root:
+    :param key:         see object_key
+    :param n_workers:
+    :return:            {'n_files', 'n_stored', 'n_linked', 'n_skipped', 'n_failed',
+                         'n_bytes', 'elapsed_secs'}
+    """
+    jobs = [(src, dst, store_root, key) for src, dst in file_pairs]
+    results, stats = run_jobs(_stage_job, jobs, n_workers=n_workers)
+    summary = {'n_files': stats['n_jobs'],
+               'n_stored': 0,
+               'n_linked': 0,
+               'n_skipped': 0,
+               'n_failed': stats['n_failed'],
+               'n_bytes': 0,
+               'elapsed_secs': stats['elapsed_secs']}
+    for job, ok, result in results:
+        if not ok:
+            print('failed to stage %s' % (job[0]))
+            continue
+        action, n_bytes = result
+        summary['n_' + action] += 1
+        summary['n_bytes'] += n_bytes
+    return summary
@@ -0,0 +1,231 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    cli.py
+#   Purpose:
+#       udcm2bids command line, heavy modules are imported by the subcommand that runs
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import argparse
+
+#----------------------------------------------------------------------------------------
+#
+def _read_rules(rules_file):
+    """
+    :param rules_file:  json list of bids_func_info dicts, see convert_uih_dcm_2_bids
+    :return:
+    """
+    with open(rules_file, 'rt', encoding='utf-8') as f_json:
+        rules = json.load(f_json)
+    if not isinstance(rules, list): raise ValueError('%s must hold a json list' % rules_file)
+    return rules
+#----------------------------------------------------------------------------------------
+#
+def _run_convert(args):
+    """
+    :param args:
+    :return:        exit code
+    """
+    from . import instrument
+    if args.events is not None or args.profile_dir is not None:
+        instrument.enable_instrumentation(events_file=args.events, profile_dir=args.profile_dir)
+    os.makedirs(args.bids_root, exist_ok=True)
+    convert_args = {'n_workers': args.workers,
+                    'use_processes': args.processes,
+                    'suvbw_dtype': args.suvbw_dtype,
+                    'pet_native': args.pet_native,
+                    'suvbw_mode': args.suvbw_mode,
+                    'suvbw_mid_frame': args.mid_frame,
+                    'compression': args.compression}
+    try:
+        if args.watch:
+            from .watch import watch_uih_dcm_2_bids
+            stats = watch_uih_dcm_2_bids(args.uih_dcm_root, args.bids_root,
+                                         _read_rules(args.rules),
+                                         poll_secs=args.poll_secs,
+                                         settle_secs=args.settle_secs,
+                                         **convert_args)
+        else:
+            from .udcm2bids import convert_uih_dcm_2_bids
+            stats = convert_uih_dcm_2_bids(args.uih_dcm_root, args.bids_root,
+                                           _read_rules(args.rules),
+                                           order=args.order,
+                                           dry_run=args.dry_run,
+                                           n_shards=args.shards,
+                                           shard_index=args.shard_index,
+                                           shard_by=args.shard_by,
+                                           lease_secs=args.lease_secs,
+                                           **convert_args)
+        if instrument.is_enabled(): instrument.print_instrumentation_summary()
+    finally:
+        instrument.disable_instrumentation()
+    return 1 if stats['n_failed'] > 0 else 0
+#----------------------------------------------------------------------------------------
+#
+def _run_inventory(args):
+    """
+    :param args:
+    :return:        exit code
+    """
+    from .udcmview import dump_series2csv
+    from .udcmview import dump_series2xlsx
+    if os.path.splitext(args.output)[1].lower() == '.csv':
+        dump_series2csv(args.dcm_root, args.output, mode=args.mode,
+                        series_file_pattern=args.pattern, index_file=args.index)
+    else:
+        dump_series2xlsx(args.dcm_root, args.output, mode=args.mode,
+                         series_file_pattern=args.pattern, index_file=args.index)
+    return 0
+#----------------------------------------------------------------------------------------
+#
+def _run_copy(args):
+    """
+    :param args:
+    :return:        exit code
+    """
+    from .udcmview import cp_series
+    cp_series(args.inventory, args.target_root, n_workers=args.workers, method=args.method,
+              store_root=args.store, store_key=args.store_key)
+    return 0
+#----------------------------------------------------------------------------------------
+#
+def _run_diff(args):
+    """
+    :param args:
+    :return:        exit code, 1 if the two files differ
+    """
+    from .dcmdiff import diff_dcm_headers
+    from .dcmdiff import scan_varying_tags
+    from .dcmdiff import print_varying_tags
+    from .discover import list_series_files
+    if len(args.paths) == 2 and all(os.path.isfile(path) for path in args.paths):
+        diffs = diff_dcm_headers(args.paths[0], args.paths[1], ignore_private=args.ignore_private)
+        for tag_path, keyword, value_0, value_1 in diffs:
+            if value_0 is not None: print('- %s %s: %r' % (tag_path, keyword, value_0))
+            if value_1 is not None: print('+ %s %s: %r' % (tag_path, keyword, value_1))
+        return 1 if diffs else 0
+    # folders expand to their series files, the whole set is compared in one pass
+    dcm_files = []
+    for path in args.paths:
+        if os.path.isdir(path): dcm_files += list_series_files(path, pattern=args.pattern)
+        else: dcm_files.append(path)
+    print_varying_tags(scan_varying_tags(dcm_files, ignore_private=args.ignore_private,
+                                         outlier_fraction=args.outlier_fraction,
+                                         n_workers=args.workers))
+    return 0
+#----------------------------------------------------------------------------------------
+#
+def build_parser():
+    """
+    :return:    argparse.ArgumentParser of the udcm2bids command
+    """
+    parser = argparse.ArgumentParser(prog='udcm2bids',
+                                     description='convert UIH DICOM exports into bids format')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    convert = subparsers.add_parser('convert', help='convert a UIH export into a bids study')
+    convert.add_argument('uih_dcm_root')
+    convert.add_argument('bids_root')
+    convert.add_argument('--rules', required=True,
+                         help='json list of {series_description, type, bids_func_name, '
+                              'bids_task_name}')
+    convert.add_argument('--workers', type=int, default=1)
+    convert.add_argument('--processes', action='store_true',
+                         help='run series in a process pool instead of threads')
+    convert.add_argument('--compression', default='gzip',
+                         help="'none', 'gzip[:level]' or 'pgzip[:level]'")
+    convert.add_argument('--suvbw-dtype', default='float32')
+    convert.add_argument('--suvbw-mode', choices=['voxel', 'header'], default='voxel')
+    convert.add_argument('--mid-frame', action='store_true',
+                         help='decay correct SUVbw to the middle of each frame')
+    convert.add_argument('--pet-native', action='store_true',
+                         help='convert UIH PET in-process, dcm2niix as fallback')
+    convert.add_argument('--order', choices=['cost', 'discovery'], default='cost')
+    convert.add_argument('--dry-run', action='store_true', help='print the plan only')
+    convert.add_argument('--shards', type=int, default=1)
+    convert.add_argument('--shard-index', type=int, default=0)
+    convert.add_argument('--shard-by', choices=['subject', 'series'], default='subject')
+    convert.add_argument('--lease-secs', type=float, default=None,
+                         help='hold a lease per series, for several workers on one cohort')
+    convert.add_argument('--watch', action='store_true',
+                         help='keep polling uih_dcm_root and convert series once complete')
+    convert.add_argument('--poll-secs', type=float, default=30.0)
+    convert.add_argument('--settle-secs', type=float, default=120.0)
+    convert.add_argument('--events', default=None, help='json-lines event file')
+    convert.add_argument('--profile-dir', default=None, help='cProfile output per series')
+    convert.set_defaults(func=_run_convert)
+
+    inventory = subparsers.add_parser('inventory', help='list the series of a dicom tree')
+    inventory.add_argument('dcm_root')
+    inventory.add_argument('output', help='.csv to append to, or .xlsx')
+    inventory.add_argument('--mode', choices=['one_per_dir', 'multi_per_dir'],
+                           default='multi_per_dir')
+    inventory.add_argument('--pattern', default='00000001.dcm',
+                           help='series file pattern of one_per_dir')
+    inventory.add_argument('--index', default=None, help='sqlite series index for rescans')
+    inventory.set_defaults(func=_run_inventory)
+
+    copy = subparsers.add_parser('copy', help='copy the series selected in an inventory')
+    copy.add_argument('inventory', help='.csv or .xlsx inventory with 07_Load set')
+    copy.add_argument('target_root')
+    copy.add_argument('--workers', type=int, default=16)
+    copy.add_argument('--method', choices=['auto', 'hardlink'], default='auto')
+    copy.add_argument('--store', default=None, help='content-addressed store to link from')
+    copy.add_argument('--store-key', choices=['sop', 'sha1'], default='sop')
+    copy.set_defaults(func=_run_copy)
+
+    diff = subparsers.add_parser('diff', help='tag level diff of dicom headers')
+    diff.add_argument('paths', nargs='+',
+                      help='two files for a pairwise diff, else files and series folders '
+                           'for a report of varying tags')
+    diff.add_argument('--ignore-private', action='store_true')
+    diff.add_argument('--pattern', default='*.dcm', help='series file pattern of folders')
+    diff.add_argument('--outlier-fraction', type=float, default=0.05)
+    diff.add_argument('--workers', type=int, default=8)
+    diff.set_defaults(func=_run_diff)
+    return parser
+#----------------------------------------------------------------------------------------
+#
+def _check_watch_args(parser, args):
+    """
+    watch converts series as they complete, options of a one-shot conversion do not apply
+    :param parser:
+    :param args:
+    :return:
+    """
+    if args.command != 'convert' or not args.watch: return
+    ignored = [option for option, is_set in (('--order', args.order != 'cost'),
+                                             ('--dry-run', args.dry_run),
+                                             ('--shards', args.shards != 1),
+                                             ('--shard-index', args.shard_index != 0),
+                                             ('--shard-by', args.shard_by != 'subject'),
+                                             ('--lease-secs', args.lease_secs is not None))
+               if is_set]
+    if ignored: parser.error('--watch cannot be combined with %s' % ', '.join(ignored))
+    return
+#----------------------------------------------------------------------------------------
+#
+def main(argv=None):
+    """
+    :param argv:    arguments without the program name, default sys.argv[1:]
+    :return:        exit code
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    _check_watch_args(parser, args)
+    return args.func(args)
+#----------------------------------------------------------------------------------------
+#
+# Test Purpose
+#
+#----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    sys.exit(main())
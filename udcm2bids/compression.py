@@ -0,0 +1,128 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    compression.py
+#   Purpose:
+#       configurable single or multi-threaded gzip of nifti outputs
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import gzip
+import zlib
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import instrument
+from .utils import part_file
+
+# uncompressed bytes per gzip member of the parallel writer
+_pgzip_chunk_size = 4 * 1024 * 1024
+
+#----------------------------------------------------------------------------------------
+#
+def parse_compression(compression='gzip'):
+    """
+    :param compression:     'none' - plain .nii
+                            'gzip' / 'gzip:<level>' - single threaded .nii.gz, level 1..9
+                            'pgzip' / 'pgzip:<level>' - multi-threaded .nii.gz
+    :return:                {'method': 'none' / 'gzip' / 'pgzip', 'level': 1..9}
+    """
+    method, _, level = str(compression).partition(':')
+    if method not in ('none', 'gzip', 'pgzip'):
+        raise ValueError('unknown compression %s' % compression)
+    if method == 'none':
+        if level: raise ValueError('compression none takes no level, got %s' % compression)
+        return {'method': method, 'level': 0}
+    level = int(level) if level else 6
+    if level < 1 or level > 9:
+        raise ValueError('gzip level must be 1..9, got %s' % compression)
+    return {'method': method, 'level': level}
+#----------------------------------------------------------------------------------------
+#
+def nifti_ext(compression='gzip'):
+    """
+    :param compression:
+    :return:                '.nii' or '.nii.gz'
+    """
+    return '.nii' if parse_compression(compression)['method'] == 'none' else '.nii.gz'
+#----------------------------------------------------------------------------------------
+#
+def _compress_member(chunk, level):
+    """
+    :param chunk:
+    :param level:
+    :return:        chunk as one complete gzip member, zlib releases the GIL while deflating
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush()
+#----------------------------------------------------------------------------------------
+#
+def _pgzip_file(src_file, gz_file, level, n_threads=None):
+    """
+    compress fixed size chunks in threads and write them in order as concatenated gzip
+    members, any gzip reader (zlib, gzip, nibabel, pigz) decompresses them as one stream
+    :param src_file:
+    :param gz_file:
+    :param level:
+    :param n_threads:   default os.cpu_count()
+    :return:
+    """
+    if n_threads is None: n_threads = os.cpu_count() or 1
+    with open(src_file, 'rb') as f_in, open(gz_file, 'wb') as f_out, \
+            ThreadPoolExecutor(max_workers=n_threads) as executor:
+        # bounded read-ahead keeps peak memory at a few chunks per thread
+        pending = []
+        while True:
+            chunk = f_in.read(_pgzip_chunk_size)
+            if not chunk: break
+            pending.append(executor.submit(_compress_member, chunk, level))
+            if len(pending) >= 2 * n_threads: f_out.write(pending.pop(0).result())
+        for future in pending: f_out.write(future.result())
+    return
+#----------------------------------------------------------------------------------------
+#
+def compress_file(src_file, gz_file, compression='gzip', n_threads=None):
+    """
+    :param src_file:
+    :param gz_file:
+    :param compression:     'gzip[:level]' or 'pgzip[:level]'
+    :param n_threads:       threads of 'pgzip', default os.cpu_count()
+    :return:
+    """
+    options = parse_compression(compression)
+    if options['method'] == 'none':
+        raise ValueError('compress_file needs a gzip compression, got %s' % compression)
+    with instrument.stage('compress'):
+        if options['method'] == 'pgzip':
+            _pgzip_file(src_file, gz_file, options['level'], n_threads=n_threads)
+        else:
+            with open(src_file, 'rb') as f_in, open(gz_file, 'wb') as f_raw, \
+                    gzip.GzipFile(filename='', mode='wb', fileobj=f_raw,
+                                  compresslevel=options['level'], mtime=0) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+    if instrument.is_enabled(): instrument.count('bytes_compressed', os.path.getsize(src_file))
+    return
+#----------------------------------------------------------------------------------------
+#
+def publish_file(src_file, dst_root, compression='gzip'):
+    """
+    move src_file into dst_root, plain .nii files are compressed on the way when configured
+    :param src_file:        file in a staging folder on the same file system as dst_root
+    :param dst_root:
+    :param compression:
+    :return:                published file
+    """
+    dst_file = os.path.join(dst_root, os.path.basename(src_file))
+    if not src_file.endswith('.nii') or nifti_ext(compression) == '.nii':
+        os.replace(src_file, dst_file)
+        return dst_file
+    dst_file += '.gz'
+    compress_file(src_file, part_file(dst_file), compression)
+    os.replace(part_file(dst_file), dst_file)
+    os.remove(src_file)
+    return dst_file
@@ -0,0 +1,203 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    dcmdiff.py
+#   Purpose:
+#       tag level diff of dicom headers, pairwise or across a series or cohort
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import hashlib
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+
+from . import instrument
+from .dcmscan import read_dcm_header
+from .discover import iter_uih_tree
+from .discover import list_series_files
+
+# binary values longer than this are compared by digest
+_max_bytes_value = 64
+
+#----------------------------------------------------------------------------------------
+#
+def _comparable(value):
+    """
+    :param value:   pydicom element value
+    :return:        hashable plain python value
+    """
+    if isinstance(value, bytes):
+        if len(value) <= _max_bytes_value: return value
+        return '<%d bytes sha1 %s>' % (len(value), hashlib.sha1(value).hexdigest()[:12])
+    if isinstance(value, (list, tuple, MultiValue)): return tuple(_comparable(v) for v in value)
+    if isinstance(value, bool): return value
+    if isinstance(value, int): return int(value)
+    if isinstance(value, float): return float(value)
+    return str(value)
+#----------------------------------------------------------------------------------------
+#
+def flatten_dataset(ds, ignore_private=False, prefix=''):
+    """
+    :param ds:              pydicom.dataset
+    :param ignore_private:
+    :param prefix:          tag path of the enclosing sequence item
+    :return:                {tag path: (keyword, value)}, e.g. '(0054,0016)[0].(0018,1075)'
+    """
+    elements = {}
+    for elem in ds:
+        if ignore_private and elem.tag.is_private: continue
+        tag_path = prefix + '(%04X,%04X)' % (elem.tag.group, elem.tag.element)
+        if elem.VR == 'SQ':
+            for i, item in enumerate(elem.value):
+                elements.update(flatten_dataset(item, ignore_private, tag_path + '[%d].' % i))
+            continue
+        elements[tag_path] = (elem.keyword or elem.name, _comparable(elem.value))
+    return elements
+#----------------------------------------------------------------------------------------
+#
+def _read_flat_header(dcm_file, ignore_private=False):
+    """
+    :param dcm_file:
+    :param ignore_private:
+    :return:                flattened header, None if the file cannot be parsed
+    """
+    # forced like the pairwise diff, files without preamble are the odd ones to report
+    try:
+        with instrument.stage('header_parse'):
+            ds = read_dcm_header(dcm_file, force=True)
+    except (InvalidDicomError, OSError, ValueError, EOFError):
+        return None
+    # a forced read of a non dicom file may end in an empty dataset
+    if len(ds) <= 0: return None
+    return flatten_dataset(ds, ignore_private=ignore_private)
+#----------------------------------------------------------------------------------------
+#
+def diff_dcm_headers(dcm_file_0, dcm_file_1, ignore_private=False):
+    """
+    :param dcm_file_0:
+    :param dcm_file_1:
+    :param ignore_private:
+    :return:                [(tag path, keyword, value_0, value_1), ...] of differing elements
+                            in tag order, None for an element missing in one file
+    """
+    elements_0 = flatten_dataset(read_dcm_header(dcm_file_0, force=True),
+                                 ignore_private=ignore_private)
+    elements_1 = flatten_dataset(read_dcm_header(dcm_file_1, force=True),
+                                 ignore_private=ignore_private)
+    diffs = []
+    for tag_path in sorted(set(elements_0) | set(elements_1)):
+        keyword_0, value_0 = elements_0.get(tag_path, (None, None))
+        keyword_1, value_1 = elements_1.get(tag_path, (None, None))
+        if tag_path in elements_0 and tag_path in elements_1 and value_0 == value_1: continue
+        diffs.append((tag_path, keyword_0 or keyword_1, value_0, value_1))
+    return diffs
+#----------------------------------------------------------------------------------------
+#
+def scan_varying_tags(dcm_files, ignore_private=False, outlier_fraction=0.05,
+                      max_outlier_files=5, n_workers=8, read_ahead=256):
+    """
+    one pass over the headers of dcm_files, e.g. all files of a series or the first file of
+    every series in a cohort, reporting the elements that are not identical in all files
+    :param dcm_files:
+    :param ignore_private:
+    :param outlier_fraction:    values held by fewer files than this fraction are outliers
+    :param max_outlier_files:   example files kept per outlier value
+    :param n_workers:           threads reading headers
+    :param read_ahead:          files read per batch
+    :return:                    {'n_files', 'unreadable': [...],
+                                 'tags': [{'tag', 'keyword', 'n_values', 'n_missing',
+                                           'min', 'max', 'common', 'per_file',
+                                           'outliers': [(value, n_files, [files])]}, ...]}
+    """
+    dcm_files = list(dcm_files)
+    keywords = {}
+    counters = {}
+    examples = {}
+    present = Counter()
+    unreadable = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for start in range(0, len(dcm_files), read_ahead):
+            batch = dcm_files[start:start + read_ahead]
+            for dcm_file, elements in zip(batch, executor.map(
+                    lambda file: _read_flat_header(file, ignore_private), batch)):
+                if elements is None:
+                    unreadable.append(dcm_file)
+                    continue
+                for tag_path, (keyword, value) in elements.items():
+                    keywords.setdefault(tag_path, keyword)
+                    present[tag_path] += 1
+                    counter = counters.setdefault(tag_path, Counter())
+                    counter[value] += 1
+                    files = examples.setdefault(tag_path, {}).setdefault(value, [])
+                    if len(files) < max_outlier_files: files.append(dcm_file)
+    n_files = len(dcm_files) - len(unreadable)
+    tags = []
+    for tag_path in sorted(counters):
+        counter = counters[tag_path]
+        n_missing = n_files - present[tag_path]
+        if len(counter) <= 1 and n_missing <= 0: continue
+        numbers = [value for value in counter
+                   if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        per_file = len(counter) == present[tag_path] and len(counter) > 1
+        common = counter.most_common(1)[0]
+        outliers = []
+        if not per_file:
+            outliers = [(value, count, examples[tag_path][value])
+                        for value, count in sorted(counter.items(), key=lambda item: item[1])
+                        if count < outlier_fraction * n_files and value != common[0]]
+        tags.append({'tag': tag_path,
+                     'keyword': keywords[tag_path],
+                     'n_values': len(counter),
+                     'n_missing': n_missing,
+                     'min': min(numbers) if numbers else None,
+                     'max': max(numbers) if numbers else None,
+                     'common': common,
+                     'per_file': per_file,
+                     'outliers': outliers})
+    return {'n_files': n_files, 'unreadable': unreadable, 'tags': tags}
+#----------------------------------------------------------------------------------------
+#
+def print_varying_tags(report):
+    """
+    :param report:  from scan_varying_tags
+    :return:
+    """
+    print('%d files, %d unreadable, %d varying tags'
+          % (report['n_files'], len(report['unreadable']), len(report['tags'])))
+    for tag in report['tags']:
+        line = '%s %-32s %6d values' % (tag['tag'], tag['keyword'], tag['n_values'])
+        if tag['n_missing'] > 0: line += ', missing in %d' % tag['n_missing']
+        if tag['min'] is not None: line += ', range %s .. %s' % (tag['min'], tag['max'])
+        if tag['per_file']: line += ', unique per file'
+        else: line += ', common %r in %d' % tag['common']
+        print(line)
+        for value, count, files in tag['outliers']:
+            print('    outlier %r in %d file(s): %s' % (value, count, ', '.join(files)))
+    return
+#----------------------------------------------------------------------------------------
+#
+def cohort_first_files(uih_dcm_root, **patient_args):
+    """
+    :param uih_dcm_root:
+    :param patient_args:    passed to discover.iter_uih_patients
+    :return:                first dicom file of every series, to compare series of a cohort
+    """
+    return [files[0] for _, _, _, files in iter_uih_tree(uih_dcm_root, **patient_args)
+            if len(files) > 0]
+#----------------------------------------------------------------------------------------
+#
+# Test Purpose
+#
+#----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    dcm_root = 'D:\\PD-control'
+    print_varying_tags(scan_varying_tags(cohort_first_files(dcm_root), ignore_private=True))
+    series_root = os.path.join(dcm_root, '2019', 'A_001_1', 'pet_dyn_1')
+    print_varying_tags(scan_varying_tags(list_series_files(series_root)))
@@ -0,0 +1,192 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    dcmscan.py
+#   Purpose:
+#       header-only scan of dicom series metadata shared by the conversion paths
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import pydicom
+
+from . import instrument
+from .discover import list_series_files
+from .manifest import files_fingerprint
+from .suvfactor import load_cached_suv
+from .suvfactor import store_cached_suv
+from .suvfactor import cohort_suvbw_factors
+from .suvfactor import series_suvbw_factors
+
+# tags required to group PET frames and calculate SUVbw factor
+_suv_tags = ['Modality',
+             'Manufacturer',
+             'SeriesInstanceUID',
+             'AcquisitionDateTime',
+             'PatientWeight',
+             'ActualFrameDuration',
+             'RadiopharmaceuticalInformationSequence']
+
+#----------------------------------------------------------------------------------------
+#
+def read_dcm_header(dcm_file, tags=None, force=False):
+    """
+    :param dcm_file:
+    :param tags:        list of keywords to parse, None to parse the whole header
+    :param force:       True to read files without preamble or 'DICM' prefix
+    :return:            pydicom.dataset without pixel data
+    """
+    return pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=tags, force=force)
+#----------------------------------------------------------------------------------------
+#
+def _calc_uih_pet_suvbw_factor(ds):
+    """
+    :param ds:  pydicom.dataset
+    :return:
+    """
+    if ds.Modality != 'PT': return 1.0
+    if ds.Manufacturer != 'UIH': return 1.0
+
+    # rescaleScople has been considering when converting to nifti1 format
+    # doseCalibraFactor = float(ds.DoseCalibrationFactor)
+    # rescaleSlope = float(ds.RescaleSlope)
+
+    # correcting dose factor
+    # dose_factor = rescaleSlope * doseCalibraFactor
+
+    # one frame through the vectorized engine
+    return series_suvbw_factors([str(ds.AcquisitionDateTime)[:14]], _read_suv_inputs(ds))[0]
+#----------------------------------------------------------------------------------------
+#
+def _read_suv_inputs(ds):
+    """
+    :param ds:  pydicom.dataset
+    :return:    dict of SUVbw inputs, empty if not UIH PET
+    """
+    if getattr(ds, 'Modality', None) != 'PT': return {}
+    if getattr(ds, 'Manufacturer', None) != 'UIH': return {}
+    radionuclide = ds.RadiopharmaceuticalInformationSequence[0]
+    return {'patient_weight': float(ds.PatientWeight),
+            'radionuclide_half_life': float(radionuclide.RadionuclideHalfLife),
+            'radionuclide_total_dose': float(radionuclide.RadionuclideTotalDose),
+            'radiopharmaceutical_start_datetime':
+                str(radionuclide.RadiopharmaceuticalStartDateTime)[:14]}
+#----------------------------------------------------------------------------------------
+#
+def _read_series_frames(dicom_files):
+    """
+    :param dicom_files:     sorted list of dicom files of one series
+    :return:                (series_uid, {acquisition datetime: frame secs}, suv_inputs)
+    """
+    frames = {}
+    series_uid = ''
+    suv_inputs = {}
+    for file in dicom_files:
+        with instrument.stage('header_parse'):
+            ds = read_dcm_header(file, tags=_suv_tags)
+        if instrument.is_enabled():
+            instrument.count('files_read')
+            instrument.count('bytes_read', os.path.getsize(file))
+        dt = str(ds.AcquisitionDateTime)[:14]
+        if dt in frames: continue
+        frames[dt] = float(getattr(ds, 'ActualFrameDuration', 0) or 0) / 1000.0
+        if not series_uid: series_uid = str(getattr(ds, 'SeriesInstanceUID', ''))
+        if not suv_inputs: suv_inputs = _read_suv_inputs(ds)
+    return series_uid, frames, suv_inputs
+#----------------------------------------------------------------------------------------
+#
+def _load_cached_series(series_dicom_root, dicom_files, fingerprint, mid_frame, cache_root):
+    """
+    :param series_dicom_root:
+    :param dicom_files:
+    :param fingerprint:     of dicom_files, see manifest.files_fingerprint
+    :param mid_frame:
+    :param cache_root:
+    :return:                cached series metadata if it matches the files, else None
+    """
+    if len(dicom_files) <= 0: return None
+    with instrument.stage('header_parse'):
+        ds = read_dcm_header(dicom_files[0], tags=['SeriesInstanceUID'])
+    entry = load_cached_suv(str(getattr(ds, 'SeriesInstanceUID', '')), cache_root=cache_root,
+                            fingerprint=fingerprint)
+    if entry is None or entry.get('n_files') != len(dicom_files) or \
+            entry.get('mid_frame') != mid_frame:
+        return None
+    instrument.count('suv_cache_hits')
+    series_meta = dict(entry)
+    series_meta['series_root'] = series_dicom_root
+    series_meta['files'] = dicom_files
+    return series_meta
+#----------------------------------------------------------------------------------------
+#
+def scan_cohort_metadata(series_list, mid_frame=False, cache_root=None):
+    """
+    read uncached series headers, then calculate the SUVbw factors of all frames in one pass
+    :param series_list:     [(series_dicom_root, dicom_files or None[, fingerprint]), ...]
+                            the fingerprint of discovery saves another stat of every file
+    :param mid_frame:       True to decay correct to the middle of each frame
+    :param cache_root:      folder of the persistent cache, None for the in-process cache only
+    :return:                list of series metadata as scan_series_metadata, in series_list order
+    """
+    series_metas = []
+    scanned = []
+    for series_item in series_list:
+        series_dicom_root, dicom_files = series_item[:2]
+        fingerprint = series_item[2] if len(series_item) > 2 else None
+        if dicom_files is None:
+            dicom_files = list_series_files(series_dicom_root)
+        dicom_files = sorted(dicom_files)
+        if fingerprint is None: fingerprint = files_fingerprint(dicom_files)
+        series_meta = _load_cached_series(series_dicom_root, dicom_files, fingerprint,
+                                          mid_frame, cache_root)
+        if series_meta is None:
+            series_uid, frames, suv_inputs = _read_series_frames(dicom_files)
+            acqdatetime = sorted(frames.keys())
+            series_meta = {'series_root': series_dicom_root,
+                           'series_uid': series_uid,
+                           'files': dicom_files,
+                           'n_files': len(dicom_files),
+                           'fingerprint': fingerprint,
+                           'acquisition_datetime': acqdatetime,
+                           'frame_secs': [frames[dt] for dt in acqdatetime],
+                           'mid_frame': mid_frame,
+                           'suv_inputs': suv_inputs}
+            scanned.append(series_meta)
+        series_metas.append(series_meta)
+    factors = cohort_suvbw_factors([(series_meta['acquisition_datetime'],
+                                     series_meta['suv_inputs'],
+                                     series_meta['frame_secs']) for series_meta in scanned],
+                                   mid_frame=mid_frame)
+    for series_meta, series_factors in zip(scanned, factors):
+        series_meta['suvbw_factor'] = series_factors
+        store_cached_suv({key: value for key, value in series_meta.items()
+                          if key not in ('series_root', 'files')}, cache_root=cache_root)
+    return series_metas
+#----------------------------------------------------------------------------------------
+#
+def scan_series_metadata(series_dicom_root, dicom_files=None, mid_frame=False, cache_root=None,
+                         fingerprint=None):
+    """
+    :param series_dicom_root:
+    :param dicom_files:     optional list of dicom files, default '*.dcm' in series root
+    :param fingerprint:     optional fingerprint of dicom_files from discovery
+    :param mid_frame:       True to decay correct to the middle of each frame
+    :param cache_root:      folder of the persistent cache, None for the in-process cache only
+    :return:                {'series_root': series_dicom_root,
+                             'series_uid': '1.2.156...',
+                             'files': [...],
+                             'n_files': ...,
+                             'fingerprint': ...,
+                             'acquisition_datetime': ['20190528101010', ...],
+                             'frame_secs': [...],
+                             'mid_frame': mid_frame,
+                             'suvbw_factor': [...],
+                             'suv_inputs': {...}}
+                            frames are sorted by acquisition datetime
+    """
+    return scan_cohort_metadata([(series_dicom_root, dicom_files, fingerprint)],
+                                mid_frame=mid_frame,
+                                cache_root=cache_root)[0]
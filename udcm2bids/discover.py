@@ -0,0 +1,120 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    discover.py
+#   Purpose:
+#       single-pass scandir discovery of UIH patient and series folders
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+
+from fnmatch import fnmatch
+
+from . import instrument
+from .utils import fingerprint_stats
+
+#----------------------------------------------------------------------------------------
+#
+def _scan_entries(path):
+    """
+    :param path:
+    :return:        non-hidden DirEntry sorted by name, like glob, empty if path is not a folder
+    """
+    try:
+        with instrument.stage('discover'):
+            with os.scandir(path) as it:
+                entries = [entry for entry in it if not entry.name.startswith('.')]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+#----------------------------------------------------------------------------------------
+#
+def _iter_study_roots(root, study_patterns):
+    """
+    :param root:
+    :param study_patterns:  one fnmatch pattern per folder level below root
+    :return:                generator of folders matching all levels
+    """
+    if len(study_patterns) <= 0:
+        yield root
+        return
+    for entry in _scan_entries(root):
+        if not entry.is_dir() or not fnmatch(entry.name, study_patterns[0]): continue
+        for study_root in _iter_study_roots(entry.path, study_patterns[1:]): yield study_root
+#----------------------------------------------------------------------------------------
+#
+def iter_uih_patients(uih_dcm_root, study_patterns=('*',), patient_pattern='*_*_*',
+                      include_image=True):
+    """
+    UIH exports patients as <root>/<study>/<name>_<id>_<n> or <root>/<study>/Image/<name>_<id>_<n>
+    :param uih_dcm_root:
+    :param study_patterns:      fnmatch patterns of the folder levels between root and patients
+    :param patient_pattern:
+    :param include_image:       also look into the 'Image' folder of every study
+    :return:                    generator of patient roots
+    """
+    for study_root in _iter_study_roots(uih_dcm_root, tuple(study_patterns)):
+        image_root = None
+        for entry in _scan_entries(study_root):
+            if not entry.is_dir(): continue
+            if entry.name == 'Image' and include_image: image_root = entry.path
+            if fnmatch(entry.name, patient_pattern): yield entry.path
+        if image_root is None: continue
+        for entry in _scan_entries(image_root):
+            if entry.is_dir() and fnmatch(entry.name, patient_pattern): yield entry.path
+#----------------------------------------------------------------------------------------
+#
+def iter_uih_series(patient_root):
+    """
+    :param patient_root:
+    :return:                generator of (series_description, series_root)
+    """
+    for entry in _scan_entries(patient_root):
+        if entry.is_dir(): yield entry.name, entry.path
+#----------------------------------------------------------------------------------------
+#
+def list_series_files(series_root, pattern='*.dcm'):
+    """
+    :param series_root:
+    :param pattern:
+    :return:                sorted list of files in series_root matching pattern
+    """
+    return [entry.path for entry in _scan_entries(series_root)
+            if fnmatch(entry.name, pattern) and entry.is_file()]
+#----------------------------------------------------------------------------------------
+#
+def scan_series_files(series_root, pattern='*.dcm'):
+    """
+    :param series_root:
+    :param pattern:
+    :return:                (sorted list of files matching pattern, total bytes, fingerprint)
+                            from one stat per file, fingerprint as manifest.files_fingerprint
+    """
+    files = []
+    n_bytes = 0
+    file_stats = []
+    for entry in _scan_entries(series_root):
+        if not fnmatch(entry.name, pattern) or not entry.is_file(): continue
+        st = entry.stat()
+        files.append(entry.path)
+        n_bytes += st.st_size
+        file_stats.append((entry.name, st.st_size, st.st_mtime_ns))
+    return files, n_bytes, fingerprint_stats(file_stats)
+#----------------------------------------------------------------------------------------
+#
+def iter_uih_tree(uih_dcm_root, pattern='*.dcm', **patient_args):
+    """
+    :param uih_dcm_root:
+    :param pattern:         file pattern of series files
+    :param patient_args:    passed to iter_uih_patients
+    :return:                generator of (patient_root, series_description, series_root, files)
+    """
+    for patient_root in iter_uih_patients(uih_dcm_root, **patient_args):
+        for series_description, series_root in iter_uih_series(patient_root):
+            yield patient_root, series_description, series_root, \
+                list_series_files(series_root, pattern=pattern)
@@ -12,11 +12,16 @@
 
 
 import os
+import sys
 import shutil
 import pandas as pd
 
+if not __package__:
+    # run as a script, e.g. python fmri_PET.py, import the package from its parent folder
+    # ahead of the script folder, where udcm2bids.py would shadow the package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from glob import glob
+from udcm2bids.discover import iter_uih_patients
 
 project_root = '\\\\dataserver02\\PET-MR02\\11. 场地数据\\北京宣武医院\\fMRI_PET'
 fmri_PET_ids = ['017','018','019','020','022','023','024','025','026','027','028','029',
@@ -26,7 +31,7 @@ fmri_PET_ids = ['017','018','019','020','022','023','024','025','026','027','028
                 '127','129','130']
 
 info = {'ID':[], 'Name':[], 'Exist':[], 'Root':[]}
-patient_roots = glob(os.path.join(project_root, '2019*', '*_*_*'))
+patient_roots = iter_uih_patients(project_root, study_patterns=('2019*',), include_image=False)
 for patient_root in patient_roots:
     patient_name_str = os.path.basename(patient_root)
     pns = patient_name_str.split('_')
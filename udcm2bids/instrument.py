@@ -0,0 +1,204 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    instrument.py
+#   Purpose:
+#       per-stage timers, counters and json-lines events, disabled by default
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import threading
+import traceback
+
+from contextlib import contextmanager
+from datetime import datetime
+
+_lock = threading.Lock()
+_state = {'enabled': False,
+          'events': None,
+          'close_events': False,
+          'profile_dir': None}
+_stage_secs = {}
+_stage_calls = {}
+_counters = {}
+
+#----------------------------------------------------------------------------------------
+#
+class _NullStage(object):
+    """
+    shared no-op context manager returned by stage() when disabled
+    """
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_null_stage = _NullStage()
+
+#----------------------------------------------------------------------------------------
+#
+def enable_instrumentation(events_file=None, profile_dir=None):
+    """
+    :param events_file:     path or writable text stream for json-lines events, None for no events
+    :param profile_dir:     folder for one cProfile .prof file per series, None to disable
+    :return:
+    """
+    disable_instrumentation()
+    with _lock:
+        _stage_secs.clear()
+        _stage_calls.clear()
+        _counters.clear()
+        if isinstance(events_file, str):
+            _state['events'] = open(events_file, 'at', encoding='utf-8')
+            _state['close_events'] = True
+        else:
+            _state['events'] = events_file
+            _state['close_events'] = False
+        if profile_dir is not None: os.makedirs(profile_dir, exist_ok=True)
+        _state['profile_dir'] = profile_dir
+        _state['enabled'] = True
+    return
+#----------------------------------------------------------------------------------------
+#
+def disable_instrumentation():
+    """
+    :return:
+    """
+    with _lock:
+        if _state['close_events'] and _state['events'] is not None: _state['events'].close()
+        _state['enabled'] = False
+        _state['events'] = None
+        _state['close_events'] = False
+        _state['profile_dir'] = None
+    return
+#----------------------------------------------------------------------------------------
+#
+def is_enabled():
+    """
+    :return:
+    """
+    return _state['enabled']
+#----------------------------------------------------------------------------------------
+#
+@contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _stage_secs[name] = _stage_secs.get(name, 0.0) + elapsed
+            _stage_calls[name] = _stage_calls.get(name, 0) + 1
+#----------------------------------------------------------------------------------------
+#
+def stage(name):
+    """
+    with stage('dcm2niix'): ...
+    :param name:
+    :return:        context manager accumulating wall time of the stage
+    """
+    if not _state['enabled']: return _null_stage
+    return _timed_stage(name)
+#----------------------------------------------------------------------------------------
+#
+def count(name, n=1):
+    """
+    :param name:    e.g. 'files_read', 'bytes_read', 'series_converted', 'series_failed'
+    :param n:
+    :return:
+    """
+    if not _state['enabled']: return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    return
+#----------------------------------------------------------------------------------------
+#
+def emit_event(event, **fields):
+    """
+    :param event:
+    :param fields:  json serialisable values
+    :return:
+    """
+    if not _state['enabled'] or _state['events'] is None: return
+    record = {'time': datetime.now().isoformat(),
+              'event': event,
+              'thread': threading.current_thread().name}
+    record.update(fields)
+    line = json.dumps(record, default=str)
+    with _lock:
+        _state['events'].write(line + '\n')
+        _state['events'].flush()
+    return
+#----------------------------------------------------------------------------------------
+#
+def emit_exception(event, exc=None, **fields):
+    """
+    :param event:
+    :param exc:     exception, or formatted traceback text, None for the one being handled
+    :param fields:
+    :return:
+    """
+    if not _state['enabled']: return
+    if exc is None or isinstance(exc, BaseException):
+        if exc is None: exc_text = traceback.format_exc()
+        else: exc_text = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    else:
+        exc_text = str(exc)
+    lines = exc_text.strip().splitlines()
+    emit_event(event, error=lines[-1] if lines else '', traceback=exc_text, **fields)
+    return
+#----------------------------------------------------------------------------------------
+#
+@contextmanager
+def profile_series(name):
+    """
+    cProfile the enclosed block into <profile_dir>/<name>.prof when profiling is enabled
+    :param name:
+    :return:
+    """
+    profile_dir = _state['profile_dir'] if _state['enabled'] else None
+    if profile_dir is None:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active in this interpreter, e.g. a concurrent series
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        profiler.dump_stats(os.path.join(profile_dir, safe_name + '.prof'))
+#----------------------------------------------------------------------------------------
+#
+def instrumentation_summary():
+    """
+    :return:    {'stages': {name: {'secs', 'calls'}}, 'counters': {name: value}}
+    """
+    with _lock:
+        return {'stages': {name: {'secs': _stage_secs[name], 'calls': _stage_calls[name]}
+                           for name in sorted(_stage_secs)},
+                'counters': dict(sorted(_counters.items()))}
+#----------------------------------------------------------------------------------------
+#
+def print_instrumentation_summary(summary=None):
+    """
+    :param summary: from instrumentation_summary, default the current one
+    :return:
+    """
+    if summary is None: summary = instrumentation_summary()
+    for name, stage_stats in summary['stages'].items():
+        print('%-24s %10.3f s %8d calls' % (name, stage_stats['secs'], stage_stats['calls']))
+    for name, value in summary['counters'].items():
+        print('%-24s %12d' % (name, value))
+    return
@@ -0,0 +1,98 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    manifest.py
+#   Purpose:
+#       conversion manifest to resume and skip unchanged series
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import json
+
+from datetime import datetime
+
+from .utils import atomic_write_json
+from .utils import fingerprint_stats
+from .discover import scan_series_files
+
+_manifest_dirname = '.udcm2bids'
+
+#----------------------------------------------------------------------------------------
+#
+def series_fingerprint(series_dicom_root, pattern='*.dcm'):
+    """
+    planned jobs carry the fingerprint of discovery, this is for series outside a plan
+    :param series_dicom_root:
+    :param pattern:
+    :return:                    sha1 of the sorted (name, size, mtime) of the series files
+    """
+    return scan_series_files(series_dicom_root, pattern=pattern)[2]
+#----------------------------------------------------------------------------------------
+#
+def files_fingerprint(files):
+    """
+    :param files:   list of files, e.g. the dicom files of one series
+    :return:        sha1 of the sorted (name, size, mtime) of files, as series_fingerprint
+    """
+    file_stats = []
+    for file in files:
+        st = os.stat(file)
+        file_stats.append((os.path.basename(file), st.st_size, st.st_mtime_ns))
+    return fingerprint_stats(file_stats)
+#----------------------------------------------------------------------------------------
+#
+def manifest_record_file(sub_root, file_stem):
+    """
+    :param sub_root:    bids subject folder
+    :param file_stem:   output name without extension
+    :return:            record file in <study_root>/.udcm2bids/<sub_name>/
+    """
+    study_root = os.path.dirname(os.path.abspath(sub_root))
+    return os.path.join(study_root, _manifest_dirname,
+                        os.path.basename(os.path.abspath(sub_root)), file_stem + '.json')
+#----------------------------------------------------------------------------------------
+#
+def is_converted(record_file, fingerprint, options=None):
+    """
+    :param record_file:
+    :param fingerprint:
+    :param options:     output options of the conversion, see write_manifest_record
+    :return:            True if the record is complete, matches fingerprint and options
+                        and all outputs exist
+    """
+    if not os.path.exists(record_file): return False
+    try:
+        with open(record_file, 'rt', encoding='utf-8') as f_json:
+            record = json.load(f_json)
+    except ValueError:
+        return False
+    if not record.get('complete') or record.get('fingerprint') != fingerprint: return False
+    if record.get('options') != (options or {}): return False
+    study_root = os.path.dirname(os.path.dirname(os.path.dirname(record_file)))
+    return all(os.path.exists(os.path.join(study_root, output))
+               for output in record.get('outputs', []))
+#----------------------------------------------------------------------------------------
+#
+def write_manifest_record(record_file, series_dicom_root, fingerprint, outputs, options=None):
+    """
+    :param record_file:
+    :param series_dicom_root:
+    :param fingerprint:
+    :param outputs:     list of output files, stored relative to the study root
+    :param options:     json serializable output options, a rerun with other options converts again
+    :return:
+    """
+    study_root = os.path.dirname(os.path.dirname(os.path.dirname(record_file)))
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    atomic_write_json(record_file,
+                      {'series_root': series_dicom_root,
+                       'fingerprint': fingerprint,
+                       'options': options or {},
+                       'outputs': sorted(os.path.relpath(output, study_root) for output in outputs),
+                       'complete': True,
+                       'finished': datetime.now().isoformat()})
+    return
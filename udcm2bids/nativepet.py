@@ -0,0 +1,263 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    nativepet.py
+#   Purpose:
+#       in-process conversion of UIH PET series into BQML and SUVbw nifti
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import pydicom
+import tempfile
+import numpy as np
+import nibabel as nib
+
+
+from . import instrument
+from .discover import list_series_files
+from .utils import atomic_write_json
+from .compression import publish_file
+from .dcmscan import _read_suv_inputs
+from .suvfactor import series_suvbw_factors
+
+#----------------------------------------------------------------------------------------
+#
+def _slice_geometry(ds):
+    """
+    :param ds:
+    :return:    (row cosine, column cosine, slice normal, position) in LPS
+    """
+    iop = np.asarray(ds.ImageOrientationPatient, dtype=np.float64)
+    row_cos, col_cos = iop[:3], iop[3:]
+    normal = np.cross(row_cos, col_cos)
+    position = np.asarray(ds.ImagePositionPatient, dtype=np.float64)
+    return row_cos, col_cos, normal, position
+#----------------------------------------------------------------------------------------
+#
+def read_uih_pet_series(series_dicom_root, dicom_files=None, mid_frame=False):
+    """
+    read a UIH PET series, raise ValueError if the layout is not supported
+    slices are grouped and sorted from headers only, then the pixels are decoded one slice
+    at a time into a single array of stored values, rescaled frame by frame when written
+    :param series_dicom_root:
+    :param dicom_files:         optional list of dicom files, default '*.dcm' in series root
+    :param mid_frame:           True to decay correct SUVbw to the middle of each frame
+    :return:                    {'raw': integer array (x, y, z, t) of stored values,
+                                 'slopes': RescaleSlope (z, t) per slice,
+                                 'inters': RescaleIntercept (z, t) per slice,
+                                 'bqml_slope': scl_slope of the BQML output,
+                                 'requantize': True if the BQML output is requantized to int16,
+                                 'affine': 4x4 RAS affine,
+                                 'acquisition_datetime': [...],
+                                 'suvbw_factor': [...],
+                                 'header': first pydicom.dataset without pixels}
+    """
+    if dicom_files is None:
+        dicom_files = list_series_files(series_dicom_root)
+    if len(dicom_files) <= 0: raise ValueError('no dicom files in %s' % series_dicom_root)
+    # group slice headers into frames by acquisition datetime
+    frames = {}
+    header = None
+    for file in sorted(dicom_files):
+        with instrument.stage('header_parse'):
+            ds = pydicom.dcmread(file, stop_before_pixels=True)
+        if ds.Modality != 'PT' or ds.Manufacturer != 'UIH':
+            raise ValueError('not a UIH PET slice %s' % file)
+        dt = str(ds.AcquisitionDateTime)[:14]
+        if header is None or dt < str(header.AcquisitionDateTime)[:14]: header = ds
+        frames.setdefault(dt, []).append(
+            (file,
+             np.asarray(ds.ImagePositionPatient, dtype=np.float64),
+             np.asarray(ds.ImageOrientationPatient, dtype=np.float64),
+             (int(ds.Rows), int(ds.Columns)),
+             float(getattr(ds, 'RescaleSlope', 1.0)),
+             float(getattr(ds, 'RescaleIntercept', 0.0)),
+             float(getattr(ds, 'ActualFrameDuration', 0) or 0) / 1000.0))
+    acqdatetime = sorted(frames.keys())
+    row_cos, col_cos, normal, _ = _slice_geometry(header)
+    rows, cols = int(header.Rows), int(header.Columns)
+    n_slices = len(frames[acqdatetime[0]])
+    positions_0 = None
+    slopes = np.empty((n_slices, len(acqdatetime)))
+    inters = np.empty((n_slices, len(acqdatetime)))
+    for t, dt in enumerate(acqdatetime):
+        slices = frames[dt]
+        if len(slices) != n_slices:
+            raise ValueError('frame %s has %d slices, expected %d' % (dt, len(slices), n_slices))
+        for _, _, iop, shape, _, _, _ in slices:
+            if shape != (rows, cols) or not np.allclose(iop, header.ImageOrientationPatient):
+                raise ValueError('inconsistent slice geometry in %s' % series_dicom_root)
+        positions = np.array([position for _, position, _, _, _, _, _ in slices])
+        order = np.argsort(positions.dot(normal))
+        positions = positions[order]
+        if positions_0 is None: positions_0 = positions
+        elif not np.allclose(positions, positions_0, atol=1e-3):
+            raise ValueError('frame %s slice positions differ from first frame' % dt)
+        frames[dt] = [slices[i] for i in order]
+        slopes[:, t] = [slice_info[4] for slice_info in frames[dt]]
+        inters[:, t] = [slice_info[5] for slice_info in frames[dt]]
+    # one scl_slope describes the stored values if all slices share it, otherwise the
+    # volume is requantized to int16 with a common slope as dcm2niix does
+    requantize = not (np.all(slopes == slopes[0, 0]) and np.all(inters == 0))
+    bqml_max = 0.0
+    raw = None
+    for t, dt in enumerate(acqdatetime):
+        for z, slice_info in enumerate(frames[dt]):
+            file = slice_info[0]
+            with instrument.stage('native_read'):
+                np_slice = pydicom.dcmread(file).pixel_array
+            if instrument.is_enabled():
+                instrument.count('files_read')
+                instrument.count('bytes_read', os.path.getsize(file))
+            if raw is None:
+                raw = np.empty((cols, rows, n_slices, len(acqdatetime)),
+                               dtype=np_slice.dtype, order='F')
+            elif np_slice.dtype != raw.dtype:
+                raise ValueError('inconsistent pixel type in %s' % series_dicom_root)
+            raw[:, :, z, t] = np_slice.T
+            if requantize:
+                bqml_max = max(bqml_max,
+                               abs(float(np_slice.min()) * slopes[z, t] + inters[z, t]),
+                               abs(float(np_slice.max()) * slopes[z, t] + inters[z, t]))
+    bqml_slope = max(bqml_max, 1e-20) / 32767.0 if requantize else float(slopes[0, 0])
+    # slice spacing must be uniform to describe the volume with one affine
+    if n_slices > 1:
+        steps = np.diff(positions_0.dot(normal))
+        if not np.allclose(steps, steps[0], rtol=1e-3, atol=1e-3):
+            raise ValueError('non-uniform slice spacing in %s' % series_dicom_root)
+        slice_vector = (positions_0[-1] - positions_0[0]) / (n_slices - 1)
+    else:
+        slice_vector = normal * float(getattr(header, 'SliceThickness', 1.0))
+    row_spacing, col_spacing = [float(v) for v in header.PixelSpacing]
+    affine = np.eye(4)
+    affine[:3, 0] = row_cos * col_spacing
+    affine[:3, 1] = col_cos * row_spacing
+    affine[:3, 2] = slice_vector
+    affine[:3, 3] = positions_0[0]
+    # dicom LPS to nifti RAS
+    affine[:2, :] *= -1
+    frame_secs = [frames[dt][0][6] for dt in acqdatetime]
+    return {'raw': raw,
+            'slopes': slopes,
+            'inters': inters,
+            'bqml_slope': bqml_slope,
+            'requantize': requantize,
+            'affine': affine,
+            'acquisition_datetime': acqdatetime,
+            'suvbw_factor': series_suvbw_factors(acqdatetime, _read_suv_inputs(header),
+                                                 frame_secs=frame_secs, mid_frame=mid_frame),
+            'header': header}
+#----------------------------------------------------------------------------------------
+#
+def _iter_bqml_frames(series):
+    """
+    :param series:  from read_uih_pet_series
+    :return:        generator of stored BQML frames (x, y, z), BQML = frame * bqml_slope
+    """
+    raw = series['raw']
+    for t in range(raw.shape[3]):
+        if not series['requantize']:
+            yield raw[..., t]
+            continue
+        np_frame = raw[..., t] * series['slopes'][:, t] + series['inters'][:, t]
+        yield np.round(np_frame / series['bqml_slope']).astype(np.int16)
+#----------------------------------------------------------------------------------------
+#
+def _iter_suvbw_frames(series, dtype):
+    """
+    :param series:  from read_uih_pet_series
+    :param dtype:   floating dtype of the frames
+    :return:        generator of SUVbw frames (x, y, z), one suvbw factor per frame
+    """
+    raw = series['raw']
+    for t, c_factor in enumerate(series['suvbw_factor']):
+        np_frame = raw[..., t].astype(dtype)
+        np_frame *= (series['slopes'][:, t] * c_factor).astype(dtype)
+        np_frame += (series['inters'][:, t] * c_factor).astype(dtype)
+        yield np_frame
+#----------------------------------------------------------------------------------------
+#
+def _write_frames(np_frames, shape, dtype, affine, nii_file, xyzt_units=('mm', 'sec'),
+                  scl_slope=1.0):
+    """
+    write the header, then the frames one at a time, peak memory is about one frame
+    :param np_frames:   iterable of (x, y, z) arrays
+    :param shape:       (x, y, z, t), a single frame is written as 3d
+    :param dtype:
+    :param affine:
+    :param nii_file:
+    :param xyzt_units:
+    :param scl_slope:   slope stored in the header, voxels are written unscaled
+    :return:
+    """
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(shape if shape[3] > 1 else shape[:3])
+    hdr.set_data_dtype(dtype)
+    hdr.set_xyzt_units(*xyzt_units)
+    hdr.set_qform(affine, code=1)
+    hdr.set_sform(affine, code=1)
+    hdr.set_slope_inter(scl_slope, 0.0)
+    hdr['vox_offset'] = 0
+    out_dtype = hdr.get_data_dtype()
+    with nib.openers.ImageOpener(nii_file, 'wb') as f_out, instrument.stage('native_write'):
+        hdr.write_to(f_out)
+        f_out.write(b'\x00' * (int(hdr['vox_offset']) - f_out.tell()))
+        for np_frame in np_frames:
+            f_out.write(np_frame.astype(out_dtype, copy=False).tobytes(order='F'))
+    return
+#----------------------------------------------------------------------------------------
+#
+def save_uih_pet_native(series_dicom_root, func_root, file_stem, suvbw_mode='voxel',
+                        dicom_files=None, compression='gzip', mid_frame=False,
+                        suvbw_dtype='float32'):
+    """
+    write <file_stem>.nii[.gz] (BQML) and the SUVbw derivative from one array of stored values
+    BQML keeps the stored integers with scl_slope, slices with differing RescaleSlope are
+    requantized to int16, so the file is about the size of the dcm2niix output
+    :param series_dicom_root:
+    :param func_root:
+    :param file_stem:           e.g. sub-001_task-rest_PET-BQML
+    :param suvbw_mode:          'header' to write static SUVbw as BQML voxels with scl_slope
+    :param dicom_files:         optional list of dicom files, default '*.dcm' in series root
+    :param compression:         see compression.parse_compression
+    :param mid_frame:           True to decay correct SUVbw to the middle of each frame
+    :param suvbw_dtype:         floating dtype of the voxel mode SUVbw output
+    :return:                    (list of output files, suvbw factors, acquisition datetimes)
+    """
+    suvbw_dtype = np.dtype(suvbw_dtype)
+    if not np.issubdtype(suvbw_dtype, np.floating):
+        raise ValueError('suvbw dtype must be floating, got %s' % suvbw_dtype)
+    series = read_uih_pet_series(series_dicom_root, dicom_files=dicom_files, mid_frame=mid_frame)
+    ds = series['header']
+    sidecar = {'Modality': str(ds.Modality),
+               'Manufacturer': str(ds.Manufacturer),
+               'SeriesDescription': str(getattr(ds, 'SeriesDescription', '')),
+               'SeriesInstanceUID': str(getattr(ds, 'SeriesInstanceUID', '')),
+               'Units': 'Bq/mL',
+               'AcquisitionDateTime': series['acquisition_datetime'],
+               'ConversionSoftware': 'udcm2bids'}
+    # write plain nifti into a staging folder, compressed while moved into func_root
+    shape = series['raw'].shape
+    with tempfile.TemporaryDirectory(prefix='.part-', dir=func_root) as tmp_root:
+        bqml_nii_file = os.path.join(tmp_root, file_stem + '.nii')
+        bqml_json_file = os.path.join(tmp_root, file_stem + '.json')
+        bqml_dtype = np.int16 if series['requantize'] else series['raw'].dtype
+        _write_frames(_iter_bqml_frames(series), shape, bqml_dtype, series['affine'],
+                      bqml_nii_file, scl_slope=series['bqml_slope'])
+        atomic_write_json(bqml_json_file, sidecar)
+        # suvbw rescaled per frame while written, one factor per frame
+        suvbw_nii_file = bqml_nii_file.replace('_PET-BQML', '_PET-SUVbw')
+        if suvbw_mode == 'header' and shape[3] == 1:
+            _write_frames(_iter_bqml_frames(series), shape, bqml_dtype, series['affine'],
+                          suvbw_nii_file,
+                          scl_slope=series['bqml_slope'] * series['suvbw_factor'][0])
+        else:
+            _write_frames(_iter_suvbw_frames(series, suvbw_dtype), shape, suvbw_dtype,
+                          series['affine'], suvbw_nii_file)
+        outputs = [publish_file(file, func_root, compression)
+                   for file in [bqml_nii_file, bqml_json_file, suvbw_nii_file]]
+    return outputs, series['suvbw_factor'], series['acquisition_datetime']
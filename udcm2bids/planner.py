@@ -0,0 +1,168 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    planner.py
+#   Purpose:
+#       to resolve and order all series conversion jobs before converting
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import re
+
+from .discover import iter_uih_series
+from .discover import iter_uih_patients
+from .discover import scan_series_files
+from .compression import nifti_ext
+
+# per file overhead of a conversion expressed in bytes, e.g. open and header parsing
+_file_cost_bytes = 64 * 1024
+
+#----------------------------------------------------------------------------------------
+#
+def compile_series_matcher(bids_func_info):
+    """
+    compile all 'series_description' substrings into one regex of optional lookaheads,
+    group i is set when rule i matches, rules without description never match
+    :param bids_func_info:
+    :return:                function(series_description) -> list of matching rule indices
+    """
+    lookaheads = []
+    for bids_func in bids_func_info:
+        description = bids_func.get('series_description')
+        if description is None: lookaheads.append('(?!)()')
+        else: lookaheads.append('(?=.*?(%s))' % re.escape(description))
+    regex = re.compile('^' + ''.join('(?:%s|)' % lookahead for lookahead in lookaheads),
+                       re.DOTALL)
+    def match(series_description):
+        groups = regex.match(series_description).groups()
+        return [i for i, group in enumerate(groups) if group is not None]
+    return match
+#----------------------------------------------------------------------------------------
+#
+def planned_outputs(job):
+    """
+    :param job:
+    :return:    main nifti outputs of the job
+    """
+    bids_func = job['bids_func']
+    func_root = os.path.join(job['sub_root'], bids_func.get('bids_func_name'))
+    file_stem = job.get('dyn_sub_name', job['sub_name']) + '_task-' + \
+                bids_func.get('bids_task_name')
+    nii_ext = nifti_ext(job.get('compression', 'gzip'))
+    if bids_func.get('type') != 'PET':
+        return [os.path.join(func_root, file_stem + '_' + bids_func.get('type') + nii_ext)]
+    return [os.path.join(func_root, file_stem + '_PET-BQML' + nii_ext),
+            os.path.join(func_root, file_stem + '_PET-SUVbw' + nii_ext)]
+#----------------------------------------------------------------------------------------
+#
+def iter_conversion_jobs(uih_dcm_root, fmri_pet_study_root, bids_func_info, pet_options=None,
+                         patient_roots=None, compression='gzip', series_roots=None):
+    """
+    :param uih_dcm_root:
+    :param fmri_pet_study_root:
+    :param bids_func_info:
+    :param pet_options:
+    :param patient_roots:       optional patient roots, default discovered below uih_dcm_root
+    :param compression:         compression of the nifti outputs
+    :param series_roots:        optional set of series roots, other series are skipped
+    :return:                    generator of series jobs in patient, rule, series order
+                                series resolving to the outputs of an earlier series are
+                                numbered, e.g. sub-001-02_task-rest_PET-BQML, filtered series
+                                are counted so the numbers do not depend on series_roots
+    """
+    if pet_options is None: pet_options = {}
+    if patient_roots is None: patient_roots = iter_uih_patients(uih_dcm_root)
+    match = compile_series_matcher(bids_func_info)
+    n_stems = {}
+    for patient_root in patient_roots:
+        # sub bids folders are created by the conversion, not while planning
+        patient_name = os.path.basename(patient_root)
+        sub_name = 'sub-' + str(patient_name.split('_')[1])
+        sub_root = os.path.join(fmri_pet_study_root, sub_name)
+        # match every series once against all rules
+        matches = [[] for _ in bids_func_info]
+        for series_description, series_dicom_root in iter_uih_series(patient_root):
+            for rule_index in match(series_description):
+                matches[rule_index].append((series_description, series_dicom_root))
+        for rule_index, bids_func in enumerate(bids_func_info):
+            for series_description, series_dicom_root in matches[rule_index]:
+                # first series keeps the plain name, later ones get -02, -03, ...
+                stem_key = (sub_root, bids_func.get('bids_func_name'),
+                            bids_func.get('bids_task_name'), bids_func.get('type'))
+                n_stems[stem_key] = n_stems.get(stem_key, 0) + 1
+                dyn_sub_name = sub_name
+                if n_stems[stem_key] > 1: dyn_sub_name += '-{:02d}'.format(n_stems[stem_key])
+                if series_roots is not None and series_dicom_root not in series_roots: continue
+                dicom_files, n_bytes, fingerprint = scan_series_files(series_dicom_root)
+                job = {'series_dicom_root': series_dicom_root,
+                       'dicom_files': dicom_files,
+                       'sub_root': sub_root,
+                       'sub_name': sub_name,
+                       'dyn_sub_name': dyn_sub_name,
+                       'series_description': series_description,
+                       'rule_index': rule_index,
+                       'bids_func': bids_func,
+                       'pet_options': pet_options,
+                       'compression': compression,
+                       'n_files': len(dicom_files),
+                       'n_bytes': n_bytes,
+                       'fingerprint': fingerprint,
+                       'cost': n_bytes + len(dicom_files) * _file_cost_bytes}
+                job['outputs'] = planned_outputs(job)
+                yield job
+#----------------------------------------------------------------------------------------
+#
+def check_unique_outputs(jobs):
+    """
+    concurrent jobs writing the same outputs would race on publishing and on the manifest
+    :param jobs:    iterable of series jobs
+    :return:        generator of the jobs, ValueError on the first job repeating an output
+    """
+    owners = {}
+    for job in jobs:
+        for output in job['outputs']:
+            owner = owners.setdefault(output, job['series_dicom_root'])
+            if owner != job['series_dicom_root']:
+                raise ValueError('%s and %s both convert to %s'
+                                 % (owner, job['series_dicom_root'], output))
+        yield job
+#----------------------------------------------------------------------------------------
+#
+def plan_uih_conversion(uih_dcm_root, fmri_pet_study_root, bids_func_info, pet_options=None,
+                        order='cost', compression='gzip'):
+    """
+    :param uih_dcm_root:
+    :param fmri_pet_study_root:
+    :param bids_func_info:
+    :param pet_options:
+    :param order:               'cost' - most expensive jobs first, 'discovery' - as found
+    :param compression:         compression of the nifti outputs
+    :return:                    list of series jobs, ValueError if two jobs share an output
+    """
+    if order not in ('cost', 'discovery'):
+        raise ValueError('unknown plan order %s' % order)
+    jobs = list(check_unique_outputs(iter_conversion_jobs(uih_dcm_root, fmri_pet_study_root,
+                                                          bids_func_info, pet_options,
+                                                          compression=compression)))
+    if order == 'cost': jobs.sort(key=lambda job: job['cost'], reverse=True)
+    return jobs
+#----------------------------------------------------------------------------------------
+#
+def print_plan(jobs):
+    """
+    :param jobs:
+    :return:
+    """
+    print('%-12s %-40s %-6s %8s %10s  %s' % ('subject', 'series', 'type', 'files', 'MB', 'output'))
+    for job in jobs:
+        print('%-12s %-40s %-6s %8d %10.1f  %s'
+              % (job['sub_name'], job['series_description'], job['bids_func'].get('type'),
+                 job['n_files'], job['n_bytes'] / 1e6, os.path.basename(job['outputs'][0])))
+    print('%d jobs, %d files, %.1f MB'
+          % (len(jobs), sum(job['n_files'] for job in jobs),
+             sum(job['n_bytes'] for job in jobs) / 1e6))
+    return
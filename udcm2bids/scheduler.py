@@ -0,0 +1,66 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    scheduler.py
+#   Purpose:
+#       to run series conversion jobs concurrently in a bounded worker pool
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+#----------------------------------------------------------------------------------------
+#
+def _run_isolated(job_func, job):
+    """
+    :param job_func:
+    :param job:
+    :return:            (ok, result or formatted exception)
+    """
+    try:
+        return True, job_func(job)
+    except Exception:
+        return False, traceback.format_exc()
+#----------------------------------------------------------------------------------------
+#
+def run_jobs(job_func, jobs, n_workers=1, use_processes=False):
+    """
+    :param job_func:        module level function taking one job, picklable if use_processes
+    :param jobs:            iterable of jobs, a generator is consumed while earlier jobs run
+    :param n_workers:       number of concurrent workers, 1 to run in the calling thread
+    :param use_processes:   True to use a process pool instead of a thread pool
+    :return:                ([(job, ok, result or error), ...] in job order,
+                             {'n_jobs', 'n_ok', 'n_failed', 'elapsed_secs', 'jobs_per_sec'})
+    """
+    start = time.perf_counter()
+    job_source = jobs
+    jobs = []
+    if n_workers <= 1:
+        outcomes = []
+        for job in job_source:
+            jobs.append(job)
+            outcomes.append(_run_isolated(job_func, job))
+    else:
+        executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_cls(max_workers=n_workers) as executor:
+            futures = []
+            for job in job_source:
+                jobs.append(job)
+                futures.append(executor.submit(_run_isolated, job_func, job))
+            outcomes = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    results = [(job, ok, result) for job, (ok, result) in zip(jobs, outcomes)]
+    n_ok = sum(1 for _, ok, _ in results if ok)
+    stats = {'n_jobs': len(jobs),
+             'n_ok': n_ok,
+             'n_failed': len(jobs) - n_ok,
+             'elapsed_secs': elapsed,
+             'jobs_per_sec': len(jobs) / elapsed if elapsed > 0 else 0.0}
+    return results, stats
@@ -0,0 +1,112 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    seriesindex.py
+#   Purpose:
+#       persistent sqlite index of dicom tags keyed by path, size and mtime
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import sqlite3
+
+# tags stored per file, in the order returned by lookup_file_tags
+index_tags = ['PatientName',
+              'PatientID',
+              'StudyDate',
+              'AcquisitionDate',
+              'AcquisitionTime',
+              'SeriesDescription']
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    subdir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    is_dicom INTEGER NOT NULL,
+    PatientName TEXT,
+    PatientID TEXT,
+    StudyDate TEXT,
+    AcquisitionDate TEXT,
+    AcquisitionTime TEXT,
+    SeriesDescription TEXT
+);
+CREATE INDEX IF NOT EXISTS files_subdir ON files (subdir);
+CREATE VIEW IF NOT EXISTS series AS
+    SELECT subdir, SeriesDescription, PatientName, PatientID, StudyDate,
+           AcquisitionDate, AcquisitionTime, COUNT(*) AS NumberofSlices
+    FROM files WHERE is_dicom = 1
+    GROUP BY subdir, SeriesDescription;
+'''
+
+#----------------------------------------------------------------------------------------
+#
+def open_series_index(index_file):
+    """
+    :param index_file:  sqlite file, created if not exist
+    :return:            sqlite3.Connection
+    """
+    conn = sqlite3.connect(index_file)
+    conn.executescript(_schema)
+    return conn
+#----------------------------------------------------------------------------------------
+#
+def stat_file(path):
+    """
+    :param path:    file path, or os.DirEntry whose stat comes with the listing on windows
+    :return:        (size, mtime_ns)
+    """
+    st = path.stat() if isinstance(path, os.DirEntry) else os.stat(path)
+    return st.st_size, st.st_mtime_ns
+#----------------------------------------------------------------------------------------
+#
+def lookup_file_tags(conn, path, size, mtime_ns):
+    """
+    :param conn:
+    :param path:
+    :param size:
+    :param mtime_ns:
+    :return:            (hit, tags) - tags is None for indexed non-dicom files
+    """
+    row = conn.execute('SELECT size, mtime_ns, is_dicom, ' + ', '.join(index_tags) +
+                       ' FROM files WHERE path = ?', (path,)).fetchone()
+    if row is None or row[0] != size or row[1] != mtime_ns: return False, None
+    if not row[2]: return True, None
+    return True, tuple(row[3:])
+#----------------------------------------------------------------------------------------
+#
+def store_file_tags(conn, path, size, mtime_ns, tags):
+    """
+    :param conn:
+    :param path:
+    :param size:
+    :param mtime_ns:
+    :param tags:        tuple ordered as index_tags, None for non-dicom files
+    :return:
+    """
+    is_dicom = tags is not None
+    if tags is None: tags = (None,) * len(index_tags)
+    conn.execute('INSERT OR REPLACE INTO files (path, subdir, size, mtime_ns, is_dicom, ' +
+                 ', '.join(index_tags) + ') VALUES (?, ?, ?, ?, ?' + ', ?' * len(index_tags) + ')',
+                 (path, os.path.dirname(path), size, mtime_ns, int(is_dicom)) + tuple(tags))
+    return
+#----------------------------------------------------------------------------------------
+#
+def prune_files(conn, dcm_root, seen_paths):
+    """
+    remove indexed files below dcm_root which were not seen in the latest scan
+    :param conn:
+    :param dcm_root:
+    :param seen_paths:
+    :return:            number of removed files
+    """
+    root = os.path.join(dcm_root, '')
+    indexed = conn.execute('SELECT path FROM files WHERE substr(path, 1, ?) = ?',
+                           (len(root), root)).fetchall()
+    stale = [(path,) for path, in indexed if path not in seen_paths]
+    conn.executemany('DELETE FROM files WHERE path = ?', stale)
+    return len(stale)
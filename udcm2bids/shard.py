@@ -0,0 +1,205 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    shard.py
+#   Purpose:
+#       deterministic sharding of conversion jobs and file-based leases in the bids tree
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from .manifest import manifest_record_file
+
+#----------------------------------------------------------------------------------------
+#
+def shard_of(key, n_shards):
+    """
+    :param key:         string identical on every node, e.g. subject name
+    :param n_shards:
+    :return:            shard index in 0..n_shards-1, independent of python hash seeds
+    """
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % n_shards
+#----------------------------------------------------------------------------------------
+#
+def select_shard(jobs, shard_index, n_shards, shard_by='subject'):
+    """
+    :param jobs:            iterable of series jobs from the planner
+    :param shard_index:     0..n_shards-1
+    :param n_shards:
+    :param shard_by:        'subject' - all series of a subject in one shard
+                            'series' - every series on its own
+    :return:                generator of the jobs of shard_index
+    """
+    if shard_index < 0 or shard_index >= n_shards:
+        raise ValueError('shard index %d out of 0..%d' % (shard_index, n_shards - 1))
+    if shard_by not in ('subject', 'series'):
+        raise ValueError('unknown shard_by %s' % shard_by)
+    for job in jobs:
+        # local paths differ between nodes, keys are built from names only
+        key = job['sub_name']
+        if shard_by == 'series': key += '/' + job['series_description']
+        if shard_of(key, n_shards) == shard_index: yield job
+#----------------------------------------------------------------------------------------
+#
+def job_lease_file(job):
+    """
+    :param job:
+    :return:    lease file next to the manifest record of the job
+    """
+    file_stem = os.path.basename(job['outputs'][0]).split('.nii')[0]
+    return os.path.splitext(manifest_record_file(job['sub_root'], file_stem))[0] + '.lease'
+#----------------------------------------------------------------------------------------
+#
+def _read_lease(lease_file):
+    """
+    :param lease_file:
+    :return:            lease record, empty while being written or if gone
+    """
+    try:
+        with open(lease_file, 'rt', encoding='utf-8') as f_json:
+            return json.load(f_json)
+    except (OSError, ValueError):
+        return {}
+#----------------------------------------------------------------------------------------
+#
+def _is_expired(lease_file, lease_secs):
+    """
+    :param lease_file:
+    :param lease_secs:
+    :return:            True if the lease was not renewed for lease_secs, None if gone
+    """
+    try:
+        return time.time() - os.stat(lease_file).st_mtime >= lease_secs
+    except FileNotFoundError:
+        return None
+#----------------------------------------------------------------------------------------
+#
+def _break_expired_lease(lease_file, lease_secs):
+    """
+    :param lease_file:
+    :param lease_secs:
+    :return:            True if the lease is gone and may be acquired
+    """
+    expired = _is_expired(lease_file, lease_secs)
+    if expired is None: return True
+    if not expired: return False
+    stale = _read_lease(lease_file)
+    # rename is atomic, only one of several workers breaking the same lease succeeds
+    broken_file = '%s.broken-%s' % (lease_file, uuid.uuid4().hex)
+    try:
+        os.rename(lease_file, broken_file)
+    except FileNotFoundError:
+        return True
+    if _read_lease(broken_file) != stale or not _is_expired(broken_file, lease_secs):
+        # another worker took the lease between the check and the rename, put it back
+        try:
+            os.link(broken_file, lease_file)
+        except FileExistsError:
+            pass
+        os.remove(broken_file)
+        return False
+    os.remove(broken_file)
+    print('broke expired lease %s of %s' % (lease_file, stale.get('host')))
+    return True
+#----------------------------------------------------------------------------------------
+#
+def acquire_lease(lease_file, lease_secs):
+    """
+    :param lease_file:
+    :param lease_secs:  a lease not renewed for lease_secs is expired and may be broken
+    :return:            token of the new lease, None if another worker holds it
+    """
+    os.makedirs(os.path.dirname(lease_file), exist_ok=True)
+    token = uuid.uuid4().hex
+    record = {'token': token,
+              'host': socket.gethostname(),
+              'pid': os.getpid(),
+              'acquired': datetime.now().isoformat()}
+    for _ in range(2):
+        try:
+            fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not _break_expired_lease(lease_file, lease_secs): return None
+            continue
+        with os.fdopen(fd, 'wt', encoding='utf-8') as f_json:
+            json.dump(record, f_json)
+        return token
+    return None
+#----------------------------------------------------------------------------------------
+#
+def renew_lease(lease_file, token):
+    """
+    :param lease_file:
+    :param token:
+    :return:            False if the lease is no longer held by token
+    """
+    if _read_lease(lease_file).get('token') != token: return False
+    os.utime(lease_file)
+    return True
+#----------------------------------------------------------------------------------------
+#
+def release_lease(lease_file, token):
+    """
+    :param lease_file:
+    :param token:
+    :return:
+    """
+    if _read_lease(lease_file).get('token') != token: return
+    try:
+        os.remove(lease_file)
+    except FileNotFoundError:
+        pass
+    return
+#----------------------------------------------------------------------------------------
+#
+def _keep_lease(lease_file, token, interval_secs, stop_event):
+    """
+    :param lease_file:
+    :param token:
+    :param interval_secs:
+    :param stop_event:
+    :return:
+    """
+    while not stop_event.wait(interval_secs):
+        if not renew_lease(lease_file, token):
+            print('lost lease %s' % lease_file)
+            return
+    return
+#----------------------------------------------------------------------------------------
+#
+@contextmanager
+def hold_lease(lease_file, lease_secs):
+    """
+    with hold_lease(lease_file, 600) as token: ... renewed in the background until released
+    :param lease_file:
+    :param lease_secs:
+    :return:            context manager yielding the token, None if held by another worker
+    """
+    token = acquire_lease(lease_file, lease_secs)
+    if token is None:
+        yield None
+        return
+    stop_event = threading.Event()
+    keeper = threading.Thread(target=_keep_lease,
+                              args=(lease_file, token, lease_secs / 3.0, stop_event),
+                              daemon=True)
+    keeper.start()
+    try:
+        yield token
+    finally:
+        stop_event.set()
+        keeper.join()
+        release_lease(lease_file, token)
@@ -0,0 +1,161 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    suvfactor.py
+#   Purpose:
+#       vectorized SUVbw factors of PET frames and a cache keyed by series instance uid
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import json
+import threading
+import numpy as np
+
+from .utils import atomic_write_json
+from .manifest import _manifest_dirname
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+#----------------------------------------------------------------------------------------
+#
+def dicom_datetime_secs(values):
+    """
+    :param values:  dicom DT strings 'YYYYMMDDHHMMSS[.ffffff]', fractions are ignored
+    :return:        float64 array of seconds since 1970-01-01, parsed without strptime
+    """
+    text = np.array([str(value)[:14] for value in values], dtype='S14')
+    if text.size <= 0: return np.zeros(0, dtype=np.float64)
+    digits = np.frombuffer(text.tobytes(), dtype=np.uint8).reshape(-1, 14).astype(np.int64)
+    digits -= ord('0')
+    if digits.min() < 0 or digits.max() > 9:
+        raise ValueError('invalid dicom datetime in %s' % list(values))
+    year = digits[:, 0:4].dot([1000, 100, 10, 1])
+    month, day, hour, minute, second = [digits[:, i:i + 2].dot([10, 1]) for i in range(4, 14, 2)]
+    dates = (year - 1970).astype('M8[Y]').astype('M8[M]') + (month - 1).astype('m8[M]')
+    dates = dates.astype('M8[D]') + (day - 1).astype('m8[D]')
+    secs = dates.astype('M8[s]').astype(np.int64) + hour * 3600 + minute * 60 + second
+    return secs.astype(np.float64)
+#----------------------------------------------------------------------------------------
+#
+def calc_suvbw_factors(acq_secs, injection_secs, half_life_secs, total_dose, patient_weight,
+                       frame_secs=None, mid_frame=False):
+    """
+    all arguments are broadcast, one numpy pass for any number of frames and series
+    :param acq_secs:        frame acquisition start times
+    :param injection_secs:  radiopharmaceutical start times
+    :param half_life_secs:
+    :param total_dose:      Bq
+    :param patient_weight:  kg
+    :param frame_secs:      frame durations, used with mid_frame
+    :param mid_frame:       True to decay correct to the middle instead of the start of frames
+    :return:                float64 array of bqml to suvbw factors
+    """
+    delta_secs = np.asarray(acq_secs, dtype=np.float64) - \
+                 np.asarray(injection_secs, dtype=np.float64)
+    if mid_frame and frame_secs is not None:
+        delta_secs = delta_secs + 0.5 * np.asarray(frame_secs, dtype=np.float64)
+    decay_factor = np.exp(np.log(2.0) / np.asarray(half_life_secs, dtype=np.float64) * delta_secs)
+    bw_factor = 1000.0 * np.asarray(patient_weight, dtype=np.float64) / \
+                np.asarray(total_dose, dtype=np.float64)
+    return decay_factor * bw_factor
+#----------------------------------------------------------------------------------------
+#
+def cohort_suvbw_factors(series_frames, mid_frame=False):
+    """
+    :param series_frames:   [(acquisition datetimes, suv_inputs, frame_secs or None), ...]
+                            suv_inputs as dcmscan._read_suv_inputs, empty if not UIH PET
+    :param mid_frame:
+    :return:                list of factor lists, one per series, 1.0 for series without inputs
+    """
+    factors = [[1.0] * len(acqdatetime) for acqdatetime, _, _ in series_frames]
+    pet = [i for i, (acqdatetime, suv_inputs, _) in enumerate(series_frames)
+           if suv_inputs and len(acqdatetime) > 0]
+    if len(pet) <= 0: return factors
+    # flatten all frames of all series, per series inputs are repeated per frame
+    n_frames = [len(series_frames[i][0]) for i in pet]
+    acq_secs = dicom_datetime_secs([dt for i in pet for dt in series_frames[i][0]])
+    frame_secs = np.concatenate([series_frames[i][2] if series_frames[i][2] is not None
+                                 else np.zeros(len(series_frames[i][0])) for i in pet])
+    inputs = [series_frames[i][1] for i in pet]
+    injection_secs = dicom_datetime_secs([suv_inputs['radiopharmaceutical_start_datetime']
+                                          for suv_inputs in inputs])
+    def per_frame(values): return np.repeat(np.asarray(values, dtype=np.float64), n_frames)
+    all_factors = calc_suvbw_factors(acq_secs,
+                                     per_frame(injection_secs),
+                                     per_frame([s['radionuclide_half_life'] for s in inputs]),
+                                     per_frame([s['radionuclide_total_dose'] for s in inputs]),
+                                     per_frame([s['patient_weight'] for s in inputs]),
+                                     frame_secs=frame_secs, mid_frame=mid_frame)
+    for i, series_factors in zip(pet, np.split(all_factors, np.cumsum(n_frames)[:-1])):
+        factors[i] = series_factors.tolist()
+    return factors
+#----------------------------------------------------------------------------------------
+#
+def series_suvbw_factors(acqdatetime, suv_inputs, frame_secs=None, mid_frame=False):
+    """
+    :param acqdatetime:     acquisition datetimes of the frames
+    :param suv_inputs:
+    :param frame_secs:
+    :param mid_frame:
+    :return:                list of factors, one per frame
+    """
+    return cohort_suvbw_factors([(acqdatetime, suv_inputs, frame_secs)], mid_frame=mid_frame)[0]
+#----------------------------------------------------------------------------------------
+#
+def suv_cache_root(sub_root):
+    """
+    :param sub_root:    bids subject folder
+    :return:            <study_root>/.udcm2bids/suv
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(sub_root)), _manifest_dirname, 'suv')
+#----------------------------------------------------------------------------------------
+#
+def load_cached_suv(series_uid, cache_root=None, fingerprint=None):
+    """
+    a re-export with corrected weight or dose keeps the series uid, so entries are only
+    valid for the files they were calculated from
+    :param series_uid:
+    :param cache_root:  folder of <series_uid>.json, None for the in-process cache only
+    :param fingerprint: fingerprint of the series files, see manifest.files_fingerprint
+    :return:            cached series metadata, None if not cached or stale
+    """
+    if not series_uid: return None
+    with _cache_lock:
+        entry = _cache.get(series_uid)
+    if entry is not None and entry.get('fingerprint') == fingerprint: return entry
+    if cache_root is None: return None
+    try:
+        cache_file = os.path.join(cache_root, series_uid + '.json')
+        with open(cache_file, 'rt', encoding='utf-8') as f_json:
+            entry = json.load(f_json)
+    except (OSError, ValueError):
+        return None
+    if entry.get('fingerprint') != fingerprint: return None
+    with _cache_lock:
+        _cache[series_uid] = entry
+    return entry
+#----------------------------------------------------------------------------------------
+#
+def store_cached_suv(entry, cache_root=None):
+    """
+    :param entry:       series metadata with 'series_uid' and 'fingerprint'
+    :param cache_root:
+    :return:
+    """
+    series_uid = entry.get('series_uid')
+    if not series_uid: return
+    with _cache_lock:
+        _cache[series_uid] = entry
+    if cache_root is None: return
+    # the cache is best effort, a concurrent writer of the same series may win
+    try:
+        os.makedirs(cache_root, exist_ok=True)
+        atomic_write_json(os.path.join(cache_root, series_uid + '.json'), entry)
+    except OSError:
+        pass
+    return
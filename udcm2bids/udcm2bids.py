@@ -11,18 +11,36 @@
 #----------------------------------------------------------------------------------------
 
 import os
-import json
-import math
-import pydicom
+import shutil
+import tempfile
 import subprocess
 import numpy as np
 import nibabel as nib
 
-from glob import glob
 from datetime import datetime
-from datetime import timedelta
 
 from .dcm2niix import dcm2niix
+from .scheduler import run_jobs
+from .planner import check_unique_outputs
+from .planner import print_plan
+from .planner import plan_uih_conversion
+from .planner import iter_conversion_jobs
+from .bulkcopy import copy_file
+from . import instrument
+from .utils import atomic_write_json
+from .compression import nifti_ext
+from .compression import publish_file
+from .compression import parse_compression
+from .manifest import is_converted
+from .manifest import series_fingerprint
+from .manifest import manifest_record_file
+from .manifest import write_manifest_record
+from .dcmscan import scan_series_metadata
+from .nativepet import save_uih_pet_native
+from .suvfactor import suv_cache_root
+from .shard import hold_lease
+from .shard import select_shard
+from .shard import job_lease_file
 
 #----------------------------------------------------------------------------------------
 #
@@ -43,103 +61,205 @@ def _diff_datetime(datetime_0, datatime_1):
     return delta_secs.total_seconds()
 #----------------------------------------------------------------------------------------
 #
-def _calc_uih_pet_suvbw_factor(ds):
+def _bqml_2_suvbw(bqml_nii_file, suvbw_nii_file, suv_factor, dtype='float32'):
     """
-    :param ds:  pydicom.dataset
+    stream bqml frames one at a time into suvbw, peak memory is about one frame
+    :param bqml_nii_file:   plain .nii is memory mapped, .nii.gz is decompressed while read
+    :param suvbw_nii_file:
+    :param suv_factor:      list of suvbw factor, one per frame
+    :param dtype:           floating output dtype
     :return:
     """
-    if ds.Modality != 'PT': return 1.0
-    if ds.Manufacturer != 'UIH': return 1.0
-
-    # rescaleScople has been considering when converting to nifti1 format
-    # doseCalibraFactor = float(ds.DoseCalibrationFactor)
-    # rescaleSlope = float(ds.RescaleSlope)
-
-    # read SUVbw tags from ds
-    acqDateTime = ds.AcquisitionDateTime
-    patientWeight = float(ds.PatientWeight)
-    radionuclide = ds.RadiopharmaceuticalInformationSequence[0]
-    radionuclideHalfLife = float(radionuclide.RadionuclideHalfLife)
-    radionuclideTotalDose = float(radionuclide.RadionuclideTotalDose)
-    radionuclideStartDateTime = radionuclide.RadiopharmaceuticalStartDateTime
-
-    # calculation of bw factor
-    bw_factor = 1000.0 * patientWeight / radionuclideTotalDose
-
-    # calculation of decay factor
-    acq_datetime_0 = datetime.strptime(str(acqDateTime)[:14], '%Y%m%d%H%M%S')
-    acq_datetime_1 = datetime.strptime(str(radionuclideStartDateTime)[:14], '%Y%m%d%H%M%S')
-    delta_secs = acq_datetime_0 - acq_datetime_1
-    decay_lambda = math.log(2) / radionuclideHalfLife
-    decay_factor = math.exp(decay_lambda * delta_secs.total_seconds())
-
-    # correcting dose factor
-    # dose_factor = rescaleSlope * doseCalibraFactor
-
-    return decay_factor * bw_factor
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.floating):
+        raise ValueError('suvbw dtype must be floating, got %s' % dtype)
+    nib_img_bqml = nib.load(bqml_nii_file)
+    hdr_bqml = nib_img_bqml.header
+    shape = nib_img_bqml.shape
+    frame_shape = shape[:3]
+    n_frames = int(np.prod(shape[3:]))
+    suv_factor = np.asarray(suv_factor, dtype=np.float64)
+    if suv_factor.size == 1: suv_factor = np.repeat(suv_factor, n_frames)
+    if suv_factor.size != n_frames:
+        raise ValueError('%d suvbw factors for %d frames in %s'
+                         % (suv_factor.size, n_frames, bqml_nii_file))
+    proxy_bqml = nib_img_bqml.dataobj
+    slope, inter = float(proxy_bqml.slope), float(proxy_bqml.inter)
+    hdr_suvbw = hdr_bqml.copy()
+    hdr_suvbw.set_data_dtype(dtype)
+    hdr_suvbw.set_slope_inter(1.0, 0.0)
+    hdr_suvbw['vox_offset'] = 0
+    out_dtype = hdr_suvbw.get_data_dtype()
+    raw_frames = _iter_raw_frames(bqml_nii_file, int(proxy_bqml.offset), proxy_bqml.dtype,
+                                  int(np.prod(frame_shape)), n_frames)
+    with nib.openers.ImageOpener(suvbw_nii_file, 'wb') as f_out, \
+            instrument.stage('suv_rescale'):
+        hdr_suvbw.write_to(f_out)
+        f_out.write(b'\x00' * (int(hdr_suvbw['vox_offset']) - f_out.tell()))
+        for c_factor, np_frame in zip(suv_factor, raw_frames):
+            np_frame = (np_frame * (slope * c_factor) + inter * c_factor).astype(out_dtype)
+            f_out.write(np_frame.tobytes())
+    return
+#----------------------------------------------------------------------------------------
+#
+def _iter_raw_frames(nii_file, offset, dtype, frame_size, n_frames):
+    """
+    raw frames are contiguous blocks in the fortran ordered voxel data
+    :param nii_file:
+    :param offset:      vox_offset of the voxel data
+    :param dtype:       on-disk dtype including byte order
+    :param frame_size:  voxels per frame
+    :param n_frames:
+    :return:            generator of 1d raw frames
+    """
+    if not nii_file.endswith('.gz'):
+        raw = np.memmap(nii_file, dtype=dtype, mode='r', offset=offset,
+                        shape=(n_frames, frame_size))
+        for t in range(n_frames): yield raw[t]
+        return
+    frame_bytes = frame_size * dtype.itemsize
+    with nib.openers.ImageOpener(nii_file, 'rb') as f_in:
+        f_in.seek(offset)
+        for _ in range(n_frames):
+            yield np.frombuffer(f_in.read(frame_bytes), dtype=dtype, count=frame_size)
+#----------------------------------------------------------------------------------------
+#
+def _bqml_2_suvbw_header(bqml_nii_file, suvbw_nii_file, suv_factor):
+    """
+    write static suvbw as the bqml voxel data with scl_slope / scl_inter scaled by suv_factor
+    :param bqml_nii_file:
+    :param suvbw_nii_file:
+    :param suv_factor:      single suvbw factor
+    :return:
+    """
+    with nib.openers.ImageOpener(bqml_nii_file, 'rb') as f_in:
+        hdr_bqml = nib.Nifti1Header.from_fileobj(f_in)
+    slope, inter = hdr_bqml.get_slope_inter()
+    if slope is None: slope, inter = 1.0, 0.0
+    if inter is None: inter = 0.0
+    hdr_suvbw = hdr_bqml.copy()
+    hdr_suvbw.set_slope_inter(slope * suv_factor, inter * suv_factor)
+    hdr_block = hdr_suvbw.binaryblock
+    if not bqml_nii_file.endswith('.gz') and not suvbw_nii_file.endswith('.gz'):
+        # clone the file and patch the header in place, no voxel is touched
+        copy_file(bqml_nii_file, suvbw_nii_file)
+        with open(suvbw_nii_file, 'r+b') as f_out:
+            f_out.write(hdr_block)
+        return
+    # compressed: swap the header block and stream the rest without dtype conversion
+    with nib.openers.ImageOpener(bqml_nii_file, 'rb') as f_in, \
+            nib.openers.ImageOpener(suvbw_nii_file, 'wb') as f_out, \
+            instrument.stage('suv_rescale'):
+        f_in.seek(len(hdr_block))
+        f_out.write(hdr_block)
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    return
+#----------------------------------------------------------------------------------------
+#
+def _run_dcm2niix(series_dicom_root, tmp_root, file_stem):
+    """
+    run dcm2niix into a staging folder, outputs are plain nifti and compressed when published
+    :param series_dicom_root:
+    :param tmp_root:            staging folder on the file system of the bids tree
+    :param file_stem:
+    :return:                    list of output files in tmp_root
+    """
+    with open(os.devnull, 'w') as devnull, instrument.stage('dcm2niix'):
+        subprocess.call([dcm2niix, '-b', 'y', '-z', 'n',
+                         '-f', file_stem,
+                         '-o', tmp_root, series_dicom_root],
+                        stdout=devnull, stderr=subprocess.STDOUT)
+    outputs = [os.path.join(tmp_root, filename) for filename in sorted(os.listdir(tmp_root))]
+    if len(outputs) <= 0:
+        raise RuntimeError('dcm2niix wrote no output for %s' % series_dicom_root)
+    return outputs
 #----------------------------------------------------------------------------------------
 #
 def _save_2_pet_suv_bqml(series_dicom_root, sub_root,
                          sub_name='sub-001',
                          func_name='pet',
-                         task_name='rest'):
+                         task_name='rest',
+                         suvbw_dtype='float32',
+                         native=False,
+                         suvbw_mode='voxel',
+                         dicom_files=None,
+                         compression='gzip',
+                         suvbw_mid_frame=False,
+                         fingerprint=None):
     """
     :param series_dicom_root:
     :param study_root:
     :param sub_name:
     :param func_name:
     :param task_name:
-    :return:
+    :param suvbw_dtype:     floating dtype of the SUVbw output
+    :param native:          True to try the in-process UIH PET conversion before dcm2niix
+    :param suvbw_mode:      'voxel' - rescale every voxel into suvbw_dtype
+                            'header' - static PET keeps the BQML voxels and scales scl_slope,
+                                       dynamic PET is written once as float32
+    :param dicom_files:     optional list of series files from discovery, default '*.dcm'
+    :param compression:     'none' / 'gzip[:level]' / 'pgzip[:level]' of BQML and SUVbw
+    :param suvbw_mid_frame: True to decay correct to the middle instead of the start of frames
+    :param fingerprint:     fingerprint of the series files from discovery, None to list them
+    :return:                'skipped' if converted before from the same files and options
     """
-    # find suv tags and calc convert factor
-    suv_factor = []
-    acqdatetime = []
-    dicom_files = glob(os.path.join(series_dicom_root, '*.dcm'))
-    for i, file in enumerate(dicom_files):
-        ds = pydicom.read_file(file, stop_before_pixels=False)
-        dt = str(ds.AcquisitionDateTime)[:14]
-        if dt not in acqdatetime:
-            acqdatetime.append(dt)
-            suv_factor.append(_calc_uih_pet_suvbw_factor(ds))
-    # convert to bids
+    if suvbw_mode not in ('voxel', 'header'):
+        raise ValueError('unknown suvbw_mode %s' % suvbw_mode)
+    if suvbw_mode == 'header': suvbw_dtype = 'float32'
+    # skip series converted completely from unchanged dicom files with the same options
+    file_stem = sub_name + '_task-' + task_name + '_PET-BQML'
+    record_file = manifest_record_file(sub_root, file_stem)
+    if fingerprint is None: fingerprint = series_fingerprint(series_dicom_root)
+    options = {'compression': parse_compression(compression),
+               'suvbw_dtype': np.dtype(suvbw_dtype).name,
+               'native': bool(native),
+               'suvbw_mode': suvbw_mode,
+               'suvbw_mid_frame': bool(suvbw_mid_frame)}
+    if is_converted(record_file, fingerprint, options): return 'skipped'
     func_root = os.path.join(sub_root, func_name)
-    if not os.path.isdir(func_root): os.mkdir(func_root)
-    # check whether exist or not
-    bqml_nii_file = os.path.join(func_root,
-                                 sub_name+'_task-'+task_name+'_PET-BQML.nii.gz')
-    if not os.path.exists(bqml_nii_file):
-        devnull = open(os.devnull, 'w')
-        subprocess.call([dcm2niix, '-b', 'y', '-z', 'y',
-                         '-f', sub_name + '_task-' + task_name + '_PET-BQML',
-                         '-o', func_root, series_dicom_root],
-                        stdout=devnull, stderr=subprocess.STDOUT)
-    # convert bqml to suv_bw with suv_factor
-    suvbw_nii_file = bqml_nii_file.replace('_PET-BQML', '_PET-SUVbw')
-    suvbw_json_file = suvbw_nii_file.replace('.nii.gz', '.json')
-    if os.path.exists(suvbw_nii_file): return
-    nib_img_bqml = nib.load(bqml_nii_file)
-    if len(suv_factor) > 1:
-        nib_3d_imgs_bqml = nib.four_to_three(nib_img_bqml)
-        np_3d_imgs_bqml = [nib_3d_img_bqml.get_data() for nib_3d_img_bqml in nib_3d_imgs_bqml]
-        affines = [nib_3d_img_bqml.affine for nib_3d_img_bqml in nib_3d_imgs_bqml]
-        np_3d_imgs_suvbw = [np_3d_img * c_factor
-                            for np_3d_img, c_factor in zip(np_3d_imgs_bqml, suv_factor)]
-        nib_3d_imgs_suvbw = [nib.Nifti1Image(new_np_3d_img, affine)
-                             for new_np_3d_img, affine in zip(np_3d_imgs_suvbw, affines)]
-        nib_img_suvbw = nib.concat_images(nib_3d_imgs_suvbw)
-        nib_img_suvbw.to_filename(suvbw_nii_file)
-    else:
-        nib_3d_img_bqml = nib_img_bqml
-        np_3d_img_bqml = nib_3d_img_bqml.get_data()
-        affine = nib_3d_img_bqml.affine
-        np_3d_img_suvbw = np_3d_img_bqml * suv_factor[0]
-        nib_3d_img_suvbw = nib.Nifti1Image(np_3d_img_suvbw, affine)
-        nib_3d_img_suvbw.to_filename(suvbw_nii_file)
-    with open(suvbw_json_file, 'wt', encoding='utf-8') as f_json:
-        json.dump({'suvbw_factor': suv_factor,
-                   'acquisition_time': acqdatetime},
-                  f_json,
-                  indent=4)
+    os.makedirs(func_root, exist_ok=True)
+    nii_ext = nifti_ext(compression)
+    suvbw_nii_file = os.path.join(func_root,
+                                  file_stem.replace('_PET-BQML', '_PET-SUVbw') + nii_ext)
+    suvbw_json_file = suvbw_nii_file.replace(nii_ext, '.json')
+    outputs = None
+    if native:
+        try:
+            outputs, suv_factor, acqdatetime = save_uih_pet_native(series_dicom_root, func_root,
+                                                                   file_stem,
+                                                                   suvbw_mode=suvbw_mode,
+                                                                   dicom_files=dicom_files,
+                                                                   compression=compression,
+                                                                   mid_frame=suvbw_mid_frame,
+                                                                   suvbw_dtype=suvbw_dtype)
+        except Exception as e:
+            print('native conversion not possible for %s, using dcm2niix - %s'
+                  %(series_dicom_root, e))
+            instrument.emit_exception('native_fallback', e, series_root=series_dicom_root)
+    if outputs is None:
+        # find suv tags and calc convert factor from dicom headers only
+        series_meta = scan_series_metadata(series_dicom_root, dicom_files=dicom_files,
+                                           mid_frame=suvbw_mid_frame,
+                                           cache_root=suv_cache_root(sub_root),
+                                           fingerprint=fingerprint)
+        suv_factor = series_meta['suvbw_factor']
+        acqdatetime = series_meta['acquisition_datetime']
+        # convert to plain bqml, then bqml to suv_bw on the memory mapped intermediate
+        with tempfile.TemporaryDirectory(prefix='.part-', dir=func_root) as tmp_root:
+            tmp_files = _run_dcm2niix(series_dicom_root, tmp_root, file_stem)
+            tmp_bqml_file = os.path.join(tmp_root, file_stem + '.nii')
+            tmp_suvbw_file = tmp_bqml_file.replace('_PET-BQML', '_PET-SUVbw')
+            if suvbw_mode == 'header' and len(suv_factor) == 1:
+                _bqml_2_suvbw_header(tmp_bqml_file, tmp_suvbw_file, suv_factor[0])
+            else:
+                _bqml_2_suvbw(tmp_bqml_file, tmp_suvbw_file, suv_factor, dtype=suvbw_dtype)
+            outputs = [publish_file(file, func_root, compression)
+                       for file in tmp_files + [tmp_suvbw_file]]
+    atomic_write_json(suvbw_json_file,
+                      {'suvbw_factor': suv_factor,
+                       'acquisition_time': acqdatetime})
+    write_manifest_record(record_file, series_dicom_root, fingerprint,
+                          sorted(set(outputs + [suvbw_nii_file, suvbw_json_file])), options)
     return
 #----------------------------------------------------------------------------------------
 #
@@ -147,7 +267,11 @@ def _save_2_generic(series_dicom_root, sub_root,
                     sub_name='sub-001',
                     func_name='func',
                     task_name='rest',
-                    series_name='T1W'):
+                    series_name='T1W',
+                    scan_metadata=False,
+                    dicom_files=None,
+                    compression='gzip',
+                    fingerprint=None):
     """
     :param series_dicom_root:
     :param sub_root:
@@ -155,29 +279,98 @@ def _save_2_generic(series_dicom_root, sub_root,
     :param func_name:
     :param task_name:
     :param series_name:
-    :return:
+    :param scan_metadata:   True to scan dicom headers and return series metadata
+    :param dicom_files:     optional list of series files from discovery, default '*.dcm'
+    :param compression:     'none' / 'gzip[:level]' / 'pgzip[:level]'
+    :param fingerprint:     fingerprint of the series files from discovery, None to list them
+    :return:                series metadata if scan_metadata,
+                            else 'skipped' if converted before from the same files and options
     """
-    dicom_files = glob(os.path.join(series_dicom_root, '*.dcm'))
-    for i, file in enumerate(dicom_files):
-        ds = pydicom.read_file(file, stop_before_pixels=False)
-        dt = str(ds.AcquisitionDateTime)[:14]
+    if fingerprint is None: fingerprint = series_fingerprint(series_dicom_root)
+    series_meta = None
+    if scan_metadata: series_meta = scan_series_metadata(series_dicom_root, dicom_files=dicom_files,
+                                                         fingerprint=fingerprint)
+    # skip series converted completely from unchanged dicom files with the same options
+    file_stem = sub_name + '_task-' + task_name + '_' + series_name
+    record_file = manifest_record_file(sub_root, file_stem)
+    options = {'compression': parse_compression(compression)}
+    if is_converted(record_file, fingerprint, options):
+        return series_meta if scan_metadata else 'skipped'
     # convert to bids
     func_root = os.path.join(sub_root, func_name)
-    if not os.path.isdir(func_root): os.mkdir(func_root)
-    # check whether exist
-    nii_file = os.path.join(func_root, sub_name + '_task-' + task_name + '_' + series_name + '_.nii.gz')
-    if os.path.exists(nii_file): return
-    devnull = open(os.devnull, 'w')
-    subprocess.call([dcm2niix, '-b', 'y', '-z', 'y',
-                     '-f', sub_name + '_task-' + task_name + '_' + series_name,
-                     '-o', func_root, series_dicom_root],
-                    stdout=devnull, stderr=subprocess.STDOUT)
+    os.makedirs(func_root, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='.part-', dir=func_root) as tmp_root:
+        outputs = [publish_file(file, func_root, compression)
+                   for file in _run_dcm2niix(series_dicom_root, tmp_root, file_stem)]
+    write_manifest_record(record_file, series_dicom_root, fingerprint, outputs, options)
+    return series_meta
+#-----------------------------------------------------------------------------------
+#
+def _convert_series_job(job):
+    """
+    :param job:     {'series_dicom_root', 'dicom_files', 'sub_root', 'sub_name',
+                     'dyn_sub_name', 'series_description', 'bids_func', 'pet_options',
+                     'compression', 'lease_secs'}
+    :return:        'leased' if another worker holds the lease of the job,
+                    'skipped' if the series was converted before, see _convert_series
+    """
+    if job.get('lease_secs') is None: return _convert_series(job)
+    with hold_lease(job_lease_file(job), job['lease_secs']) as token:
+        if token is None:
+            print('skipping %s - %s, leased by another worker'
+                  %(job['sub_name'], job['series_description']))
+            return 'leased'
+        return _convert_series(job)
+#-----------------------------------------------------------------------------------
+#
+def _convert_series(job):
+    """
+    :param job:
+    :return:        'skipped' if the outputs are up to date, else None
+    """
+    bids_func = job['bids_func']
+    print('working on %s - %s'%(job['sub_name'], job['series_description']))
+    instrument.emit_event('series_start', sub_name=job['sub_name'],
+                          series_root=job['series_dicom_root'])
+    with instrument.profile_series(job['sub_name'] + '_' + job['series_description']):
+        if bids_func.get('type') != 'PET':
+            result = _save_2_generic(job['series_dicom_root'], job['sub_root'], job['dyn_sub_name'],
+                            func_name=bids_func.get('bids_func_name'),
+                            task_name=bids_func.get('bids_task_name'),
+                            series_name=bids_func.get('type'),
+                            dicom_files=job.get('dicom_files'),
+                            compression=job.get('compression', 'gzip'),
+                            fingerprint=job.get('fingerprint'))
+        else:
+            result = _save_2_pet_suv_bqml(job['series_dicom_root'], job['sub_root'], job['dyn_sub_name'],
+                                 func_name=bids_func.get('bids_func_name'),
+                                 task_name=bids_func.get('bids_task_name'),
+                                 dicom_files=job.get('dicom_files'),
+                                 compression=job.get('compression', 'gzip'),
+                                 fingerprint=job.get('fingerprint'),
+                                 **job['pet_options'])
+    if result == 'skipped':
+        print('skipped %s - %s, outputs up to date'%(job['sub_name'], job['series_description']))
+        return 'skipped'
     return
 #-----------------------------------------------------------------------------------
 #
 def convert_uih_dcm_2_bids(uih_dcm_root,
                            fmri_pet_study_root,
-                           bids_func_info):
+                           bids_func_info,
+                           n_workers=1,
+                           use_processes=False,
+                           suvbw_dtype='float32',
+                           pet_native=False,
+                           suvbw_mode='voxel',
+                           suvbw_mid_frame=False,
+                           order='cost',
+                           dry_run=False,
+                           compression='gzip',
+                           n_shards=1,
+                           shard_index=0,
+                           shard_by='subject',
+                           lease_secs=None):
     """
     :param uih_dcm_root:
     :param fmri_pet_study_root:
@@ -186,41 +379,95 @@ def convert_uih_dcm_2_bids(uih_dcm_root,
                                   'bids_func_name': 'anat',
                                   'bids_task_name': 'rest',
                                   'bids_session_name' : '01'}, ... ]
-
-    :return:
+    :param n_workers:           number of series converted concurrently
+    :param use_processes:       True to run series in a process pool instead of threads
+                                stage timers and events of udcm2bids.instrument are only
+                                collected from thread workers, not from a process pool
+    :param suvbw_dtype:         floating dtype of the PET SUVbw outputs
+    :param pet_native:          True to convert UIH PET in-process, dcm2niix as fallback
+    :param suvbw_mode:          'voxel' / 'header', see _save_2_pet_suv_bqml
+    :param suvbw_mid_frame:     True to decay correct SUVbw to the middle of each frame
+    :param order:               'cost' - plan all jobs first and convert the largest first
+                                'discovery' - convert series while they are discovered
+    :param dry_run:             True to print the plan without converting
+    :param compression:         'none' - plain .nii
+                                'gzip[:level]' - .nii.gz, level 1..9, default 6
+                                'pgzip[:level]' - multi-threaded .nii.gz
+    :param n_shards:            split the cohort into n_shards by a hash of the names
+    :param shard_index:         shard converted by this worker, 0..n_shards-1
+    :param shard_by:            'subject' / 'series', see shard.select_shard
+    :param lease_secs:          hold a lease file per series in the bids tree while converting,
+                                None to disable, leases not renewed for lease_secs expire
+    :return:                    {'n_jobs', 'n_ok', 'n_failed', 'n_leased', 'n_skipped',
+                                 'elapsed_secs', 'jobs_per_sec'}
+                                n_ok counts converted series only, series with up to date
+                                outputs are counted in n_skipped
     """
-    # find the patient root defined as '*_*_*' - UIH specific exported dicom pattern
-    patient_roots = glob(os.path.join(uih_dcm_root, '*', '*_*_*'))
-    patient_roots += glob(os.path.join(uih_dcm_root, '*', 'Image', '*_*_*'))
-    for patient_root in patient_roots:
-        # create sub bids folders
-        patient_name = os.path.basename(patient_root)
-        sub_name = 'sub-' + str(patient_name.split('_')[1])
-        sub_root = os.path.join(fmri_pet_study_root, sub_name)
-        if not os.path.exists(sub_root): os.mkdir(sub_root)
-        series_descriptions = os.listdir(patient_root)
-        for bids_func in bids_func_info:
-            i = 0
-            for series_description in series_descriptions:
-                if not bids_func.get('series_description') in series_description: continue
-                print('working on %s - %s'%(sub_name, series_description))
-                try:
-                    dyn_sub_name = sub_name
-                    dyn_sub_name + '-{:02d}'.format(i)
-                    series_dicom_root = os.path.join(patient_root, series_description)
-                    if bids_func.get('type') != 'PET':
-                        _save_2_generic(series_dicom_root, sub_root, dyn_sub_name,
-                                        func_name=bids_func.get('bids_func_name'),
-                                        task_name=bids_func.get('bids_task_name'),
-                                        series_name=bids_func.get('type'))
-                    else:
-                        _save_2_pet_suv_bqml(series_dicom_root, sub_root, dyn_sub_name,
-                                             func_name=bids_func.get('bids_func_name'),
-                                             task_name=bids_func.get('bids_task_name'))
-                    i += 1
-                except:
-                    print('failed to convert %s - %s' %(sub_name, series_description))
-    return
+    parse_compression(compression)
+    pet_options = {'suvbw_dtype': suvbw_dtype, 'native': pet_native, 'suvbw_mode': suvbw_mode,
+                   'suvbw_mid_frame': suvbw_mid_frame}
+    if order == 'discovery' and not dry_run:
+        # checked while streaming, the job repeating an output stops the run before submitting
+        jobs = check_unique_outputs(iter_conversion_jobs(uih_dcm_root, fmri_pet_study_root,
+                                                         bids_func_info, pet_options,
+                                                         compression=compression))
+    else:
+        with instrument.stage('plan'):
+            jobs = plan_uih_conversion(uih_dcm_root, fmri_pet_study_root, bids_func_info,
+                                       pet_options, order=order, compression=compression)
+    if n_shards > 1:
+        jobs = select_shard(jobs, shard_index, n_shards, shard_by=shard_by)
+    if lease_secs is not None:
+        jobs = (dict(job, lease_secs=lease_secs) for job in jobs)
+    if dry_run:
+        jobs = list(jobs)
+        print_plan(jobs)
+        return {'n_jobs': len(jobs), 'n_ok': 0, 'n_failed': 0, 'n_leased': 0, 'n_skipped': 0,
+                'elapsed_secs': 0.0, 'jobs_per_sec': 0.0}
+    return _run_conversion(jobs, n_workers=n_workers, use_processes=use_processes)[1]
+#-----------------------------------------------------------------------------------
+#
+def _run_conversion(jobs, n_workers=1, use_processes=False):
+    """
+    :param jobs:            iterable of series jobs from the planner
+    :param n_workers:
+    :param use_processes:
+    :return:                ([(job, ok, result or error), ...],
+                             {'n_jobs', 'n_ok', 'n_failed', 'n_leased', 'n_skipped',
+                              'elapsed_secs', 'jobs_per_sec'})
+    """
+    # convert series in a bounded pool, failures are isolated per series
+    results, stats = run_jobs(_convert_series_job, jobs,
+                              n_workers=n_workers, use_processes=use_processes)
+    stats['n_leased'] = 0
+    stats['n_skipped'] = 0
+    for job, ok, result in results:
+        if ok and result == 'leased':
+            stats['n_leased'] += 1
+            instrument.count('series_leased')
+            continue
+        if ok and result == 'skipped':
+            stats['n_skipped'] += 1
+            instrument.count('series_skipped')
+            continue
+        if ok:
+            instrument.count('series_converted')
+            instrument.emit_event('series_done', sub_name=job['sub_name'],
+                                  series_root=job['series_dicom_root'])
+            continue
+        print('failed to convert %s - %s' %(job['sub_name'], job['series_description']))
+        instrument.count('series_failed')
+        instrument.emit_exception('series_failed', result, sub_name=job['sub_name'],
+                                  series_root=job['series_dicom_root'])
+    stats['n_ok'] -= stats['n_leased'] + stats['n_skipped']
+    print('converted %d of %d series (%d up to date, %d failed, %d leased by others) '
+          'in %.1f s - %.2f series/s'
+          %(stats['n_ok'], stats['n_jobs'], stats['n_skipped'], stats['n_failed'],
+            stats['n_leased'], stats['elapsed_secs'], stats['jobs_per_sec']))
+    if instrument.is_enabled():
+        instrument.emit_event('convert_done', summary=instrument.instrumentation_summary(),
+                              **stats)
+    return results, stats
 #----------------------------------------------------------------------------------------
 #
 # Test Purpose
@@ -12,22 +12,254 @@
 
 import os
 import re
-import difflib
-import pydicom
-import shutil
+import sys
+import ast
+import json
 
 import pandas as pd
 
-from glob import glob
-from pydicom.misc import is_dicom
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.errors import InvalidDicomError
 
+if not __package__:
+    # run as a script, e.g. python udcmview.py, import the package from its parent folder
+    # ahead of the script folder, where udcm2bids.py would shadow the package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from udcm2bids import instrument
+from udcm2bids.bulkcopy import copy_files
+from udcm2bids.castore import stage_files
+from udcm2bids.dcmscan import read_dcm_header
+from udcm2bids.dcmdiff import diff_dcm_headers
+from udcm2bids.discover import iter_uih_patients
+from udcm2bids.seriesindex import index_tags
+from udcm2bids.seriesindex import stat_file
+from udcm2bids.seriesindex import open_series_index
+from udcm2bids.seriesindex import lookup_file_tags
+from udcm2bids.seriesindex import store_file_tags
+from udcm2bids.seriesindex import prune_files
+from udcm2bids.utils import atomic_write_json
+
+# inventory columns kept as text when read back, e.g. leading zeros of PatientID
+_inventory_str_columns = {'01_PatientName': str,
+                          '02_PatientID': str,
+                          '03_StudyDate': str,
+                          '04_AcquisitionDateTime': str,
+                          '05_SeriesDescription': str,
+                          '08_SeriesRoot': str}
+
+# excel cells hold at most this many characters, longer file lists go to a sidecar
+_excel_cell_chars = 32767
+
+#----------------------------------------------------------------------------------------
+#
+def _read_series_tags(dcm_file):
+    """
+    :param dcm_file:
+    :return:            tags ordered as seriesindex.index_tags, None if not dicom
+    """
+    try:
+        with instrument.stage('header_parse'):
+            ds = read_dcm_header(dcm_file, tags=index_tags)
+    except InvalidDicomError:
+        return None
+    instrument.count('files_read')
+    return tuple(str(getattr(ds, tag)) if hasattr(ds, tag) else 'NA' for tag in index_tags)
+#----------------------------------------------------------------------------------------
+#
+def _walk_files(dcm_root):
+    """
+    os.walk keeping the DirEntry of files, so a rescan needs no extra stat per file
+    :param dcm_root:
+    :return:            generator of (subdir, {file name: os.DirEntry}), top down
+    """
+    subdirs = [dcm_root]
+    while subdirs:
+        subdir = subdirs.pop()
+        files = {}
+        dirs = []
+        try:
+            with os.scandir(subdir) as it:
+                for entry in it:
+                    # like os.walk, linked folders are listed but not descended
+                    if entry.is_dir():
+                        if not entry.is_symlink(): dirs.append(entry.path)
+                        continue
+                    files[entry.name] = entry
+        except OSError:
+            continue
+        yield subdir, files
+        subdirs.extend(reversed(dirs))
+#----------------------------------------------------------------------------------------
+#
+def _submit_series_tags(dcm_file, index_conn=None, executor=None, entry=None):
+    """
+    :param dcm_file:
+    :param index_conn:  optional series index, only new or changed files are parsed
+    :param executor:    optional thread pool reading headers ahead
+    :param entry:       optional os.DirEntry of dcm_file from the folder listing
+    :return:            (dcm_file, size, mtime_ns, tags or future, needs_store)
+    """
+    size, mtime_ns = None, None
+    if index_conn is not None:
+        size, mtime_ns = stat_file(entry if entry is not None else dcm_file)
+        hit, tags = lookup_file_tags(index_conn, dcm_file, size, mtime_ns)
+        if hit:
+            instrument.count('index_hits')
+            return dcm_file, size, mtime_ns, tags, False
+    if executor is None: tags = _read_series_tags(dcm_file)
+    else: tags = executor.submit(_read_series_tags, dcm_file)
+    return dcm_file, size, mtime_ns, tags, index_conn is not None
+#----------------------------------------------------------------------------------------
+#
+def _resolve_series_tags(read, index_conn=None):
+    """
+    :param read:        returned by _submit_series_tags
+    :param index_conn:
+    :return:            tags ordered as seriesindex.index_tags, None if not dicom
+    """
+    dcm_file, size, mtime_ns, tags, needs_store = read
+    if isinstance(tags, Future): tags = tags.result()
+    if needs_store: store_file_tags(index_conn, dcm_file, size, mtime_ns, tags)
+    return tags
+#----------------------------------------------------------------------------------------
+#
+def _append_dir_series(series, subdir, r_files, reads, index_conn=None):
+    """
+    :param series:      dict of lists filled by dump_series2json
+    :param subdir:
+    :param r_files:
+    :param reads:       one _submit_series_tags result per file of r_files
+    :param index_conn:
+    :return:            number of resolved files
+    """
+    # series of the folder in first seen order, keyed by description and folder
+    dir_series = {}
+    for file, read in zip(r_files, reads):
+        tags = _resolve_series_tags(read, index_conn)
+        if tags is None: continue
+        pname, pid, sdate, acqdate, acqtime, sdecrp = tags
+        series_key = str(sdecrp + subdir)
+        if series_key not in dir_series:
+            dir_series[series_key] = {'tags': (pname, pid, sdate, acqdate + acqtime, sdecrp),
+                                      'files': []}
+        dir_series[series_key]['files'].append(file)
+    for dir_serie in dir_series.values():
+        pname, pid, sdate, acqdatetime, sdecrp = dir_serie['tags']
+        series['01_PatientName'].append(pname)
+        series['02_PatientID'].append(pid)
+        series['03_StudyDate'].append(sdate)
+        series['04_AcquisitionDateTime'].append(acqdatetime)
+        series['05_SeriesDescription'].append(sdecrp)
+        series['06_NumberofSlices'].append(len(dir_serie['files']))
+        series['07_Load'].append(False)
+        series['08_SeriesRoot'].append(subdir)
+        series['09_SeriesFiles'].append(dir_serie['files'])
+    return len(reads)
+#----------------------------------------------------------------------------------------
+#
+def _format_series_files(series):
+    """
+    :param series:      dict of lists from dump_series2json
+    :return:            pandas.DataFrame with '09_SeriesFiles' stored as json text
+    """
+    df = pd.DataFrame(series)
+    df['09_SeriesFiles'] = [json.dumps(files, ensure_ascii=False) for files in series['09_SeriesFiles']]
+    return df
+#----------------------------------------------------------------------------------------
+#
+def _parse_series_files(series_files):
+    """
+    :param series_files:    json text, or python list text written by older versions
+    :return:                list of file names, None if missing or truncated
+    """
+    if isinstance(series_files, list): return series_files
+    if not isinstance(series_files, str) or not series_files: return None
+    try:
+        return json.loads(series_files)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(series_files)
+    except (ValueError, SyntaxError):
+        return None
+#----------------------------------------------------------------------------------------
+#
+def _series_files_sidecar(inventory_file):
+    """
+    :param inventory_file:
+    :return:                <inventory>_files.json holding the file lists of an xlsx inventory
+    """
+    return os.path.splitext(inventory_file)[0] + '_files.json'
+#----------------------------------------------------------------------------------------
+#
+def _series_files_key(series_root, series_description):
+    """
+    :param series_root:
+    :param series_description:
+    :return:                    sidecar key, a folder may hold several series
+    """
+    return str(series_root) + '|' + str(series_description)
+#----------------------------------------------------------------------------------------
+#
+def _to_excel(df, xlsx_file):
+    """
+    write df to xlsx_file, file lists too long for a cell are kept in the sidecar only
+    :param df:          inventory with '09_SeriesFiles' as json text
+    :param xlsx_file:
+    :return:
+    """
+    sidecar_file = _series_files_sidecar(xlsx_file)
+    sidecar = {}
+    if os.path.exists(sidecar_file):
+        with open(sidecar_file, 'rt', encoding='utf-8') as f_json:
+            sidecar = json.load(f_json)
+    cells = []
+    for series_root, series_description, series_files in zip(df['08_SeriesRoot'].values,
+                                                             df['05_SeriesDescription'].values,
+                                                             df['09_SeriesFiles'].values):
+        files = _parse_series_files(series_files)
+        if files is not None:
+            sidecar[_series_files_key(series_root, series_description)] = files
+        if isinstance(series_files, str) and len(series_files) > _excel_cell_chars:
+            series_files = ''
+        cells.append(series_files)
+    df = df.copy()
+    df['09_SeriesFiles'] = cells
+    atomic_write_json(sidecar_file, sidecar)
+    df.to_excel(xlsx_file)
+    return
+#----------------------------------------------------------------------------------------
+#
+def _relist_series_files(series_root, series_description):
+    """
+    :param series_root:
+    :param series_description:
+    :return:                    names of the series files in series_root, by their headers
+    """
+    series_files = []
+    for entry in sorted(os.scandir(series_root), key=lambda entry: entry.name):
+        if not entry.is_file(): continue
+        try:
+            ds = read_dcm_header(entry.path, tags=['SeriesDescription'])
+        except InvalidDicomError:
+            continue
+        if str(getattr(ds, 'SeriesDescription', 'NA')) == series_description:
+            series_files.append(entry.name)
+    return series_files
 #----------------------------------------------------------------------------------------
 #
-def dump_series2json(dcm_root, mode='one_per_dir', series_file_pattern='00000001.dcm'):
+def dump_series2json(dcm_root, mode='one_per_dir', series_file_pattern='00000001.dcm',
+                     index_file=None, n_workers=8, read_ahead=256):
     """
     :param dcm_root:
     :param mode:        'one_per_dir'
     :param series_file_pattern:
+    :param index_file:  optional sqlite series index, rescans only parse new or changed files
+    :param n_workers:   threads reading dicom headers, 1 to read in the calling thread
+    :param read_ahead:  maximum number of files read ahead of the folder being collected
     :return:
     """
     if not os.path.exists(dcm_root): return {}
@@ -40,95 +272,130 @@ def dump_series2json(dcm_root, mode='one_per_dir', series_file_pattern='00000001
               '07_Load':[],
               '08_SeriesRoot':[],
               '09_SeriesFiles':[]}
-    for subdir, _, files in os.walk(dcm_root):
-        if len(files) <= 0: continue
-        print('working on %s' % (subdir))
-        # find right patterned files
-        re_pattern = series_file_pattern.replace('*', '.*')
-        r_files = []
-        if mode != 'one_per_dir': r_files = files
-        else:
-            for file in files: r_files += re.findall(re_pattern, file)
-            r_files.sort()
-            r_files = [r_files[0]]
-        # iterate all found files
-        pnames = []
-        pids = []
-        sdates = []
-        sdecrps = []
-        acqdatetimes = []
-        subdirs = []
-        slices = {}
-        series_keys = []
-        for file in r_files:
-            dcm_file = os.path.join(subdir, file)
-            if not is_dicom(dcm_file): continue
-            ds = pydicom.read_file(dcm_file)
-            if hasattr(ds, 'AcquisitionDate'): acqdate = str(ds.AcquisitionDate)
-            else: acqdate = 'NA'
-            if hasattr(ds, 'AcquisitionTime'): acqtime = str(ds.AcquisitionTime)
-            else: acqtime = 'NA'
-            if hasattr(ds, 'PatientName'): pname = str(ds.PatientName)
-            else: pname = 'NA'
-            if hasattr(ds, 'PatientID'): pid = str(ds.PatientID)
-            else: pid = 'NA'
-            if hasattr(ds, 'StudyDate'): sdate = str(ds.StudyDate)
-            else: sdate = 'NA'
-            if hasattr(ds, 'SeriesDescription'): sdecrp = str(ds.SeriesDescription)
-            else: sdecrp = 'NA'
-            series_key = str(sdecrp + subdir)
-            if series_key not in series_keys:
-                series_keys.append(series_key)
-                slices[series_key] = []
-                pnames.append(pname)
-                pids.append(pid)
-                sdates.append(sdate)
-                sdecrps.append(sdecrp)
-                acqdatetimes.append(acqdate + acqtime)
-                subdirs.append(subdir)
-            slices[series_key].append(file)
-        # append to series
-        series['01_PatientName'] += pnames
-        series['02_PatientID'] += pids
-        series['03_StudyDate'] += sdates
-        series['04_AcquisitionDateTime'] += acqdatetimes
-        series['05_SeriesDescription'] += sdecrps
-        series['07_Load'] += [False] * len(pnames)
-        series['08_SeriesRoot'] += subdirs
-        for series_key in series_keys:
-            series['06_NumberofSlices'].append(len(slices[series_key]))
-            series['09_SeriesFiles'].append(slices[series_key])
+    index_conn = None
+    seen_paths = set()
+    if index_file is not None: index_conn = open_series_index(index_file)
+    executor = ThreadPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    re_pattern = series_file_pattern.replace('*', '.*')
+    # folders whose headers are being read, collected in walk order
+    pending = deque()
+    n_pending = 0
+    try:
+        for subdir, entries in _walk_files(dcm_root):
+            if len(entries) <= 0: continue
+            files = list(entries)
+            print('working on %s' % (subdir))
+            seen_paths.update(os.path.join(subdir, file) for file in files)
+            # find right patterned files
+            r_files = []
+            if mode != 'one_per_dir': r_files = files
+            else:
+                for file in files: r_files += re.findall(re_pattern, file)
+                r_files.sort()
+                r_files = [r_files[0]]
+            reads = [_submit_series_tags(os.path.join(subdir, file), index_conn, executor,
+                                         entry=entries.get(file))
+                     for file in r_files]
+            pending.append((subdir, r_files, reads))
+            n_pending += len(reads)
+            while n_pending > read_ahead and len(pending) > 1:
+                n_pending -= _append_dir_series(series, *pending.popleft(), index_conn=index_conn)
+        while pending:
+            _append_dir_series(series, *pending.popleft(), index_conn=index_conn)
+    finally:
+        if executor is not None: executor.shutdown(wait=True, cancel_futures=True)
+    if index_conn is not None:
+        prune_files(index_conn, dcm_root, seen_paths)
+        index_conn.commit()
+        index_conn.close()
     return series
 #----------------------------------------------------------------------------------------
 #
-def dump_series2xlsx(dcm_root, xlsx_file, mode='one_per_dir', series_file_pattern='00000001.dcm'):
+def dump_series2xlsx(dcm_root, xlsx_file, mode='one_per_dir', series_file_pattern='00000001.dcm',
+                     index_file=None):
     """
     :param dcm_root:
     :param xlsx_file:
     :param mode:            'one_per_dir'
     :param series_file_pattern:
-    :return:
+    :param index_file:      optional sqlite series index
+    :return:                file lists are also kept in <xlsx>_files.json, see _to_excel
     """
-    series = dump_series2json(dcm_root, mode=mode, series_file_pattern=series_file_pattern)
+    series = dump_series2json(dcm_root, mode=mode, series_file_pattern=series_file_pattern,
+                              index_file=index_file)
     if os.path.exists(xlsx_file):
-        df_0 = pd.read_excel(xlsx_file)
-        df_1 = pd.DataFrame(series)
+        df_0 = pd.read_excel(xlsx_file, dtype=_inventory_str_columns)
+        df_1 = _format_series_files(series)
         df = pd.concat([df_0, df_1], axis=0, sort=True)
     else:
-        df = pd.DataFrame(series)
-    df.to_excel(xlsx_file)
+        df = _format_series_files(series)
+    _to_excel(df, xlsx_file)
     return
 #----------------------------------------------------------------------------------------
 #
-def cp_series(xlsx_file, target_root):
+def dump_series2csv(dcm_root, csv_file, mode='one_per_dir', series_file_pattern='00000001.dcm',
+                    index_file=None):
     """
+    append the series of dcm_root to csv_file without re-reading existing rows
+    :param dcm_root:
+    :param csv_file:
+    :param mode:            'one_per_dir'
+    :param series_file_pattern:
+    :param index_file:      optional sqlite series index
+    :return:
+    """
+    series = dump_series2json(dcm_root, mode=mode, series_file_pattern=series_file_pattern,
+                              index_file=index_file)
+    if len(series.get('02_PatientID', [])) <= 0: return
+    write_header = not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0
+    _format_series_files(series).to_csv(csv_file, mode='a', header=write_header, index=False)
+    return
+#----------------------------------------------------------------------------------------
+#
+def csv2xlsx(csv_file, xlsx_file):
+    """
+    one-shot excel export of an inventory built with dump_series2csv
+    :param csv_file:
     :param xlsx_file:
+    :return:
+    """
+    if not os.path.exists(csv_file): return
+    df = pd.read_csv(csv_file, dtype=_inventory_str_columns)
+    _to_excel(df, xlsx_file)
+    return
+#----------------------------------------------------------------------------------------
+#
+def _read_inventory(inventory_file):
+    """
+    :param inventory_file:  .csv or .xlsx inventory
+    :return:                pandas.DataFrame
+    """
+    if os.path.splitext(inventory_file)[1].lower() == '.csv':
+        return pd.read_csv(inventory_file, dtype=_inventory_str_columns)
+    return pd.read_excel(inventory_file, dtype=_inventory_str_columns)
+#----------------------------------------------------------------------------------------
+#
+def cp_series(xlsx_file, target_root, n_workers=16, method='auto', store_root=None,
+              store_key='sop'):
+    """
+    :param xlsx_file:       .xlsx or .csv inventory
     :param target_root:
+    :param n_workers:       concurrent file copies
+    :param method:          'auto' / 'hardlink', see bulkcopy.copy_file
+    :param store_root:      content-addressed store, e.g. shared between exports and runs,
+                            series files are links into it, None to copy files directly
+    :param store_key:       'sop' / 'sha1', see castore.object_key
     :return:
     """
     if not os.path.exists(xlsx_file): return
     if not os.path.exists(target_root): os.makedirs(target_root)
-    tags = pd.read_excel(xlsx_file)
+    tags = _read_inventory(xlsx_file)
+    sidecar = {}
+    sidecar_file = _series_files_sidecar(xlsx_file)
+    if os.path.splitext(xlsx_file)[1].lower() != '.csv' and os.path.exists(sidecar_file):
+        with open(sidecar_file, 'rt', encoding='utf-8') as f_json:
+            sidecar = json.load(f_json)
+    file_pairs = []
     patient_ids = tags['02_PatientID'].values
     for i, patient_id in enumerate(patient_ids):
         load = tags['07_Load'].values[i]
@@ -137,38 +404,42 @@ def cp_series(xlsx_file, target_root):
         study_date = str(tags['03_StudyDate'].values[i])
         acqdatetime = str(tags['04_AcquisitionDateTime'].values[i])
         series_root_0 = str(tags['08_SeriesRoot'].values[i])
-        series_files_strs = tags['09_SeriesFiles'].values[i]
-        series_files_strs = series_files_strs.replace('\'', '')
-        series_files_strs = series_files_strs.replace('[', '')
-        series_files_strs = series_files_strs.replace(']', '')
-        series_files_strs = series_files_strs.replace(' ', '')
-        series_files = series_files_strs.split(',')
+        series_files = _parse_series_files(tags['09_SeriesFiles'].values[i])
+        # excel truncates long cells, use the sidecar or list the series again
+        if series_files is None:
+            series_files = sidecar.get(_series_files_key(series_root_0, series_description))
+        if series_files is None:
+            series_files = _relist_series_files(series_root_0, series_description)
         series_root_1 = os.path.join(target_root, str(patient_id), study_date, acqdatetime + '_' + series_description)
-        if not os.path.exists(series_root_1): os.makedirs(series_root_1)
-        for file in series_files:
-            filename = str(file)
-            shutil.copyfile(os.path.join(series_root_0, filename), os.path.join(series_root_1, filename))
+        os.makedirs(series_root_1, exist_ok=True)
+        file_pairs += [(os.path.join(series_root_0, str(file)), os.path.join(series_root_1, str(file)))
+                       for file in series_files]
+    if store_root is not None:
+        stats = stage_files(file_pairs, store_root, key=store_key, n_workers=n_workers)
+        print('stored %d, linked %d, skipped %d, failed %d of %d files - %.1f MB in %.1f s'
+              %(stats['n_stored'], stats['n_linked'], stats['n_skipped'], stats['n_failed'],
+                stats['n_files'], stats['n_bytes'] / 1e6, stats['elapsed_secs']))
+        return
+    stats = copy_files(file_pairs, n_workers=n_workers, method=method)
+    print('copied %d, linked %d, skipped %d, failed %d of %d files - %.1f MB in %.1f s'
+          %(stats['n_copied'], stats['n_linked'], stats['n_skipped'], stats['n_failed'],
+            stats['n_files'], stats['n_bytes'] / 1e6, stats['elapsed_secs']))
     return
 #----------------------------------------------------------------------------------------
 #
-def diff_dcm_files(dcm_file_0, dcm_file_1):
+def diff_dcm_files(dcm_file_0, dcm_file_1, ignore_private=False):
     """
+    print the header elements which differ between two dicom files
     :param dcm_file_0:
     :param dcm_file_1:
-    :return:
+    :param ignore_private:
+    :return:                [(tag path, keyword, value_0, value_1), ...]
     """
-    ds_0 = pydicom.read_file(dcm_file_0, force=True)
-    ds_1 = pydicom.read_file(dcm_file_1, force=True)
-    dss = tuple([ds_0, ds_1])
-    rep = []
-    for ds in dss:
-        lines = str(ds).split("\n")
-        lines = [line + "\n" for line in lines]  # add the newline to end
-        rep.append(lines)
-    diff = difflib.Differ()
-    for line in diff.compare(rep[0], rep[1]):
-        if line[0] != "?": print(line)
-    return
+    diffs = diff_dcm_headers(dcm_file_0, dcm_file_1, ignore_private=ignore_private)
+    for tag_path, keyword, value_0, value_1 in diffs:
+        if value_0 is not None: print('- %s %s: %r' % (tag_path, keyword, value_0))
+        if value_1 is not None: print('+ %s %s: %r' % (tag_path, keyword, value_1))
+    return diffs
 
 #----------------------------------------------------------------------------------------
 #
@@ -178,11 +449,17 @@ def diff_dcm_files(dcm_file_0, dcm_file_1):
 if __name__ == '__main__':
     dcm_root = '\\\\dataserver02\\PET-MR02\\11. 场地数据\北京宣武医院\\fMRI_PET'
     xlsx_file = 'E:\\xuanwu.xlsx'
-    patient_roots = glob(os.path.join(dcm_root, '2019*', '*', 'Image', '*_*'))
-    patient_roots += glob(os.path.join(dcm_root, '2019*', '*', '*_*'))
+    csv_file = 'E:\\xuanwu.csv'
+    index_file = 'E:\\xuanwu.sqlite'
+    instrument.enable_instrumentation(events_file='E:\\xuanwu_events.jsonl')
+    patient_roots = iter_uih_patients(dcm_root, study_patterns=('2019*', '*'), patient_pattern='*_*')
     for patient_root in patient_roots:
         try:
             print('working on %s'%(patient_root))
-            dump_series2xlsx(patient_root, xlsx_file, mode='multi_per_dir')
-        except:
+            dump_series2csv(patient_root, csv_file, mode='multi_per_dir', index_file=index_file)
+        except Exception:
             print('failed in converting %s'%(patient_root))
+            instrument.emit_exception('inventory_failed', patient_root=patient_root)
+    csv2xlsx(csv_file, xlsx_file)
+    instrument.print_instrumentation_summary()
+    instrument.disable_instrumentation()
@@ -9,3 +9,38 @@
 #   Author: hui.liu02@united-imaging.com
 #   Created 2019-06-13
 #----------------------------------------------------------------------------------------
+
+import os
+import json
+import hashlib
+
+#----------------------------------------------------------------------------------------
+#
+def part_file(path):
+    """
+    :param path:
+    :return:        hidden temporary name in the same folder, keeping the extension
+    """
+    return os.path.join(os.path.dirname(path), '.part-' + os.path.basename(path))
+#----------------------------------------------------------------------------------------
+#
+def atomic_write_json(json_file, obj):
+    """
+    :param json_file:
+    :param obj:
+    :return:
+    """
+    tmp_file = part_file(json_file)
+    with open(tmp_file, 'wt', encoding='utf-8') as f_json:
+        json.dump(obj, f_json, indent=4)
+    os.replace(tmp_file, json_file)
+    return
+#----------------------------------------------------------------------------------------
+#
+def fingerprint_stats(file_stats):
+    """
+    :param file_stats:  iterable of (file name, size, mtime_ns)
+    :return:            sha1 of the sorted stats, order of listing does not matter
+    """
+    entries = sorted('%s|%d|%d' % file_stat for file_stat in file_stats)
+    return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
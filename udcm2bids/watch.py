@@ -0,0 +1,221 @@
+#----------------------------------------------------------------------------------------
+#
+#   Project - udcm2bids
+#   Description:
+#       A python processing package to convert UIH DICOM into bids format
+#   File Name:    watch.py
+#   Purpose:
+#       to convert series continuously as they arrive in a UIH export root
+#   Author: hui.liu02@united-imaging.com
+#   Created 2019-06-13
+#----------------------------------------------------------------------------------------
+
+import os
+import time
+
+from fnmatch import fnmatch
+
+from . import instrument
+from .discover import _scan_entries
+from .discover import iter_uih_series
+from .discover import iter_uih_patients
+from .planner import check_unique_outputs
+from .planner import iter_conversion_jobs
+from .compression import parse_compression
+from .udcm2bids import _run_conversion
+
+#----------------------------------------------------------------------------------------
+#
+def _mtime_ns(path):
+    """
+    :param path:
+    :return:        st_mtime_ns, None if path is gone
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+#----------------------------------------------------------------------------------------
+#
+def _series_signature(series_root, pattern='*.dcm'):
+    """
+    :param series_root:
+    :param pattern:
+    :return:            (n_files, n_bytes, newest mtime_ns) from one scandir, no file is opened
+    """
+    n_files, n_bytes, newest = 0, 0, 0
+    for entry in _scan_entries(series_root):
+        if not fnmatch(entry.name, pattern) or not entry.is_file(): continue
+        st = entry.stat()
+        n_files += 1
+        n_bytes += st.st_size
+        newest = max(newest, st.st_mtime_ns)
+    return n_files, n_bytes, newest
+#----------------------------------------------------------------------------------------
+#
+def _poll_patients(uih_dcm_root, patient_mtimes, series_state):
+    """
+    register the series of new or changed patient folders, unchanged patients are not listed
+    :param uih_dcm_root:
+    :param patient_mtimes:  {patient_root: mtime_ns}, updated
+    :param series_state:    {series_root: {'patient_root', 'signature', 'dir_mtime', 'done',
+                                           'n_failures', 'retry_ns'}}
+    :return:
+    """
+    for patient_root in iter_uih_patients(uih_dcm_root):
+        mtime = _mtime_ns(patient_root)
+        if mtime is None or patient_mtimes.get(patient_root) == mtime: continue
+        patient_mtimes[patient_root] = mtime
+        for _, series_root in iter_uih_series(patient_root):
+            series_state.setdefault(series_root, {'patient_root': patient_root,
+                                                  'signature': None,
+                                                  'dir_mtime': None,
+                                                  'done': False,
+                                                  'n_failures': 0,
+                                                  'retry_ns': 0})
+    return
+#----------------------------------------------------------------------------------------
+#
+def _poll_series(series_state, settle_secs):
+    """
+    a series is complete when file count, bytes and newest mtime did not change since the
+    previous poll and the newest file is at least settle_secs old, series are only marked
+    done by _mark_converted, a failed series is returned again once its retry time passed
+    :param series_state:
+    :param settle_secs:
+    :return:                {patient_root: set of complete series roots}
+    """
+    now_ns = time.time_ns()
+    ready = {}
+    for series_root in list(series_state):
+        state = series_state[series_root]
+        dir_mtime = _mtime_ns(series_root)
+        if dir_mtime is None:
+            del series_state[series_root]
+            continue
+        if state['done']:
+            # files added to or removed from a converted series bring it back
+            if dir_mtime == state['dir_mtime']: continue
+            state['done'] = False
+            state['signature'] = None
+        signature = _series_signature(series_root)
+        stable = signature == state['signature']
+        if not stable:
+            # changed files deserve an immediate retry
+            state['n_failures'] = 0
+            state['retry_ns'] = 0
+        state['signature'] = signature
+        state['dir_mtime'] = dir_mtime
+        if not stable or signature[0] <= 0: continue
+        if now_ns - signature[2] < settle_secs * 1e9: continue
+        if now_ns < state['retry_ns']: continue
+        ready.setdefault(state['patient_root'], set()).add(series_root)
+    return ready
+#----------------------------------------------------------------------------------------
+#
+def _mark_converted(series_state, series_roots, results, poll_secs, max_retry_secs):
+    """
+    :param series_state:
+    :param series_roots:    series handed to the conversion
+    :param results:         from _run_conversion, a series may have one job per matching rule
+    :param poll_secs:
+    :param max_retry_secs:  cap of the retry backoff, poll_secs doubled per failure
+    :return:
+    """
+    failed = set(job['series_dicom_root'] for job, ok, _ in results if not ok)
+    now_ns = time.time_ns()
+    for series_root in series_roots:
+        state = series_state.get(series_root)
+        if state is None: continue
+        if series_root not in failed:
+            state['done'] = True
+            state['n_failures'] = 0
+            state['retry_ns'] = 0
+            continue
+        state['n_failures'] += 1
+        backoff_secs = min(max_retry_secs, poll_secs * 2 ** (state['n_failures'] - 1))
+        state['retry_ns'] = now_ns + int(backoff_secs * 1e9)
+        print('retrying %s in %g s' % (series_root, backoff_secs))
+    return
+#----------------------------------------------------------------------------------------
+#
+def watch_uih_dcm_2_bids(uih_dcm_root,
+                         fmri_pet_study_root,
+                         bids_func_info,
+                         poll_secs=30.0,
+                         settle_secs=120.0,
+                         max_cycles=None,
+                         max_retry_secs=3600.0,
+                         n_workers=1,
+                         use_processes=False,
+                         suvbw_dtype='float32',
+                         pet_native=False,
+                         suvbw_mode='voxel',
+                         suvbw_mid_frame=False,
+                         compression='gzip'):
+    """
+    poll uih_dcm_root and convert every series once it is complete, until interrupted
+    :param uih_dcm_root:        incoming UIH export root
+    :param fmri_pet_study_root:
+    :param bids_func_info:      see convert_uih_dcm_2_bids
+    :param poll_secs:           seconds between the start of two polls
+    :param settle_secs:         minimum age of the newest file of a complete series
+    :param max_cycles:          number of polls, None to run until KeyboardInterrupt
+    :param max_retry_secs:      longest wait before a failed series is converted again
+    :param n_workers:
+    :param use_processes:
+    :param suvbw_dtype:
+    :param pet_native:
+    :param suvbw_mode:
+    :param suvbw_mid_frame:
+    :param compression:
+    :return:                    {'n_cycles', 'n_jobs', 'n_ok', 'n_skipped', 'n_failed'}
+    """
+    parse_compression(compression)
+    pet_options = {'suvbw_dtype': suvbw_dtype, 'native': pet_native, 'suvbw_mode': suvbw_mode,
+                   'suvbw_mid_frame': suvbw_mid_frame}
+    patient_mtimes = {}
+    series_state = {}
+    totals = {'n_cycles': 0, 'n_jobs': 0, 'n_ok': 0, 'n_skipped': 0, 'n_failed': 0}
+    print('watching %s every %g s' % (uih_dcm_root, poll_secs))
+    try:
+        while max_cycles is None or totals['n_cycles'] < max_cycles:
+            start = time.monotonic()
+            with instrument.stage('watch_poll'):
+                _poll_patients(uih_dcm_root, patient_mtimes, series_state)
+                ready = _poll_series(series_state, settle_secs)
+            totals['n_cycles'] += 1
+            n_ready = sum(len(series_roots) for series_roots in ready.values())
+            instrument.emit_event('watch_poll', n_series=len(series_state), n_ready=n_ready)
+            if n_ready > 0:
+                series_roots = set().union(*ready.values())
+                jobs = check_unique_outputs(iter_conversion_jobs(
+                    uih_dcm_root, fmri_pet_study_root, bids_func_info, pet_options,
+                    patient_roots=sorted(ready), compression=compression,
+                    series_roots=series_roots))
+                results, stats = _run_conversion(jobs, n_workers=n_workers,
+                                                 use_processes=use_processes)
+                _mark_converted(series_state, series_roots, results, poll_secs, max_retry_secs)
+                for key in ('n_jobs', 'n_ok', 'n_skipped', 'n_failed'): totals[key] += stats[key]
+            if max_cycles is not None and totals['n_cycles'] >= max_cycles: break
+            time.sleep(max(0.0, poll_secs - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        print('watch stopped')
+    print('watched %d polls, converted %d of %d series (%d up to date, %d failed)'
+          % (totals['n_cycles'], totals['n_ok'], totals['n_jobs'], totals['n_skipped'],
+             totals['n_failed']))
+    return totals
+#----------------------------------------------------------------------------------------
+#
+# Test Purpose
+#
+#----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    dicom_root  = 'D:\\UIH-export'
+    bids_root   = 'D:\\UIH-export_bids'
+    if not os.path.exists(bids_root): os.mkdir(bids_root)
+    bids_func_info = [{'series_description': 'pet',
+                       'type': 'PET',
+                       'bids_func_name': 'pet',
+                       'bids_task_name': 'rest'}]
+    watch_uih_dcm_2_bids(dicom_root, bids_root, bids_func_info)